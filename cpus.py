@@ -0,0 +1,103 @@
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+#numeric libraries that size their thread pools from these when they are loaded
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"]
+
+
+# function to read a core list like 0-3,6,8-9
+def parse(spec):
+    cores = []
+    for part in spec.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cores.extend(range(int(first), int(last) + 1))
+        elif part.strip():
+            cores.append(int(part))
+    return sorted(set(cores))
+
+
+# function to get the cores this process may use, can be limited with the VOSKRIBE_CORES environment variable
+def available():
+    if os.environ.get("VOSKRIBE_CORES", ""):
+        return parse(os.environ["VOSKRIBE_CORES"])
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# function to split cores into one contiguous set per worker process, workers share cores only if there are more workers than cores
+def split(cores, workers):
+    if workers >= len(cores):
+        return [[cores[i % len(cores)]] for i in range(workers)]
+    size, extra = divmod(len(cores), workers)
+    sets = []
+    for i in range(workers):
+        start = i * size + min(i, extra)
+        sets.append(cores[start:start + size + (1 if i < extra else 0)])
+    return sets
+
+
+# function to confine this process to a set of cores and size the thread pools of the numeric libraries to it,
+# has to run before vosk or torch are imported
+def pin(cores):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(len(cores))
+
+
+# shares the cores of a process between vosk recognizers (one core each) and torch's intra-op threads for punctuation,
+# moving a core to whichever of the two has more work waiting
+class Scheduler:
+
+    def __init__(self, cores, punctuation=True):
+        self.cores = len(cores)
+        self.punctuation = punctuation and self.cores > 1
+        #start with half of the cores for each, all of them decode if there is nothing to punctuate
+        self.decoders = self.cores - self.cores // 2 if self.punctuation else self.cores
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    def torch_threads(self):
+        return max(1, self.cores - self.decoders)
+
+    # function to size torch's thread pool to the cores punctuation has now, has to run in the thread that punctuates
+    # as torch keeps a thread count per thread in its OpenMP builds
+    def apply(self):
+        if self.punctuation and "torch" in sys.modules:
+            sys.modules["torch"].set_num_threads(self.torch_threads())
+
+    # context manager a recognizer runs in, waits while all cores given to decoding are busy
+    @contextmanager
+    def decoding(self):
+        with self.condition:
+            self.waiting += 1
+            while self.active >= self.decoders:
+                self.condition.wait()
+            self.waiting -= 1
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    # function to move a core between decoding and punctuation, given how many files wait for each of them,
+    # punctuation picks up its share with apply()
+    def rebalance(self, decoding, punctuating):
+        if not self.punctuation:
+            return
+        with self.condition:
+            decoding += self.waiting
+            if punctuating > decoding and self.decoders > 1:
+                self.decoders -= 1
+            elif decoding > punctuating and self.decoders < self.cores - 1:
+                self.decoders += 1
+            else:
+                return
+            self.condition.notify_all()
@@ -1,64 +1,110 @@
 import torch
+import pyannote.audio
 from pyannote.audio.pipelines.speaker_verification import PretrainedSpeakerEmbedding
 from pyannote.audio import Audio, Pipeline
 from pyannote.core import Annotation, Segment
+import os
 import time
+import hashlib
 import numpy
 import glob
 from pathlib import Path
 import sys
-from scipy.spatial.distance import cdist
+from concurrent.futures import ProcessPoolExecutor
+
+from speakers import SpeakerIndex
+
+#pretrained models used for segmentation and speaker embeddings
+#set these to local paths (pipeline config.yaml, speechbrain model directory) to diarize offline
+PIPELINE_MODEL = os.environ.get("VOSKRIBE_DIARIZATION_PIPELINE", "pyannote/speaker-diarization")
+EMBEDDING_MODEL = os.environ.get("VOSKRIBE_SPEAKER_EMBEDDING", "speechbrain/spkrec-ecapa-voxceleb")
+
+#recordings longer than this (in seconds) are diarized window by window with constant memory
+STREAM_AFTER = 2 * 3600.
+WINDOW = 300.
+#maximum cosine distance between a window's speaker and a running centroid to count as the same speaker
+LINK_DISTANCE = 0.5
+
+#models and speaker indexes loaded by this process, shared by all diarize objects
+loaded_models = {}
+loaded_indexes = {}
+
+
+#load segmentation pipeline and embedding model, only once per process
+def load_models(pipeline_model=PIPELINE_MODEL, embedding_model=EMBEDDING_MODEL):
+    if (pipeline_model, embedding_model) not in loaded_models:
+        print("loading diarization models...")
+        model = PretrainedSpeakerEmbedding(embedding_model, device=torch.device("cpu"))
+        pipeline = Pipeline.from_pretrained(pipeline_model)
+        loaded_models[(pipeline_model, embedding_model)] = (pipeline, model)
+    return loaded_models[(pipeline_model, embedding_model)]
+
+
+#load a speaker index once per process, and again only when it was changed on disk
+def load_index(speakers_dir=None):
+    index = loaded_indexes.get(speakers_dir)
+    if index is None or (index.store.exists() and index.store.stat().st_mtime != index.mtime):
+        index = SpeakerIndex(speakers_dir)
+        index.mtime = index.store.stat().st_mtime if index.store.exists() else None
+        loaded_indexes[speakers_dir] = index
+    return index
+
+
+#compute a single reference embedding for a whole audio file, e.g. for enrolling a speaker
+def embed_file(file):
+    pipeline, model = load_models()
+    audio = Audio(sample_rate=model.sample_rate, mono=True)
+    waveform, sample_rate = audio(file)
+    with torch.no_grad():
+        return model(waveform[None])
+
+
+#diarize one file with the models of this process, used by diarize_many's worker processes
+def diarize_one(file, speakers_dir=None):
+    return diarize(file, speakers_dir).do_diarization()
+
+
+#diarize many files in sequence, or with a pool of worker processes that each load the models once
+def diarize_many(files, speakers_dir=None, workers=1):
+    if workers <= 1:
+        diarizer = diarize(None, speakers_dir)
+        for file in files:
+            yield file, diarizer.do_diarization(file)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for file, result in zip(files, pool.map(diarize_one, files, [speakers_dir] * len(files))):
+            yield file, result
+
 
 class diarize:
 
-    def __init__(self, file):
+    #cache_file is the media the cached results are kept next to, if the audio is decoded somewhere else (e.g. in the PCM cache)
+    def __init__(self, file=None, speakers_dir=None, cache_file=None):
         self.AUDIO_FILE = file
+        self.CACHE_FILE = cache_file
 
         #where is the stuff we need for our work
         #ROOT_DIR = "/Users/inter/Documents/!code/pyannote/pyannote-audio"
-        self.EMBEDDINGS_DIR = Path(r"\\DATEN\Schöpferwissen\.training")
+        self.speakers_dir = speakers_dir
+        self.index = load_index(speakers_dir)
+        self.pipeline, self.model = load_models()
 
         #define some variables for identifying recognized speakers
-        self.speakers = {"known": [], "identified": []}
+        #"identified" maps each pyannote label to its vote counts for every enrolled name plus "???"
+        self.speakers = {"identified": {}}
         self.lastspeaker = "none"
         self.speakerchanges = []
-
-        #fetch all embeddings from directory and load them into our speakers dict
-        all_embeds = sorted(self.EMBEDDINGS_DIR.glob('*.emb'))
-        for e in all_embeds:
-            with open(e, "r") as file: some_embed = numpy.loadtxt(file, ndmin=2)
-            if '_thomas_' in e.stem:
-                self.speakers["known"].append({"name": "Thomas", "embedding": some_embed})
-            elif '_julia_' in e.stem:
-                self.speakers["known"].append({"name": "Julia", "embedding": some_embed})
-            elif '_heiko_' in e.stem:
-                self.speakers["known"].append({"name": "Heiko", "embedding": some_embed})
-            elif '_julian_' in e.stem:
-                self.speakers["known"].append({"name": "Julian", "embedding": some_embed})
-        print("loaded", len(self.speakers["known"]), "signatures")
+        print("loaded", len(self.index.rownames), "signatures of", len(self.index), "speakers")
 
     #add a new recognized speaker to our dict
-    @staticmethod
-    def addspeaker(speakers, name):
-        speakers["identified"].append({"name": name, "Thomas": 0, "Julia": 0, "Heiko": 0, "Julian": 0, "???": 0})
+    def addspeaker(self, speakers, name):
+        speakers["identified"][name] = numpy.zeros(len(self.index) + 1, dtype=numpy.int64)
         return speakers
 
-    #measure distances of an embedding to all known speakers and raise the appropriate identification counter
-    @staticmethod
-    def measuredistance(speakers, lastembedding, lastspeaker):
-        hasbeenidentified = False
-        for k in range(len(speakers["known"])):
-            dist = cdist(lastembedding, speakers["known"][k]["embedding"], metric="cosine")
-            #here we define the maximum distance (between 0 and 1) to count as an identifiction
-            if dist <= 0.25:
-                for i in range(len(speakers["identified"])):
-                    if speakers["identified"][i]["name"] == lastspeaker:
-                        speakers["identified"][i][speakers["known"][k]["name"]] += 1
-                hasbeenidentified = True
-        if hasbeenidentified == False:
-            for i in range(len(speakers["identified"])):
-                    if speakers["identified"][i]["name"] == lastspeaker:
-                        speakers["identified"][i]["???"] += 1
+    #search a batch of embeddings in the speaker index and raise the identification counters of their labels
+    def measuredistance(self, speakers, embeddings, labels):
+        for counts, label in zip(self.index.votes(embeddings), labels):
+            speakers["identified"][label] += counts
         return speakers
 
     def make_readable_list(self, diary):
@@ -73,24 +119,68 @@ class diarize:
             newdiary.append(f"{starttimemin:02d}:{starttimesek:02d} - {endtimemin:02d}:{endtimesek:02d} {speaker} ({confidence}%)")
         return newdiary
 
-    def do_diarization(self):
-        #define variables for pyannote
-        audio = Audio(sample_rate=48000, mono=True)
-        model = PretrainedSpeakerEmbedding("speechbrain/spkrec-ecapa-voxceleb", device=torch.device("cpu"))
-        pipeline = Pipeline.from_pretrained("pyannote/speaker-diarization")
+    #compute embeddings for all collected segments from the in-memory waveform, in padded batches
+    @staticmethod
+    def embed_segments(model, waveform, sample_rate, segments, batch_size=32):
+        embeddings = numpy.zeros((len(segments), model.dimension), dtype=numpy.float32)
+        #sort segments by duration, so that each batch needs as little padding as possible
+        order = sorted(range(len(segments)), key=lambda i: segments[i].duration)
+        for b in range(0, len(order), batch_size):
+            batch = order[b:b + batch_size]
+            crops = [waveform[:, int(segments[i].start * sample_rate):int(segments[i].end * sample_rate)] for i in batch]
+            longest = max(c.shape[1] for c in crops)
+            waveforms = torch.zeros(len(crops), 1, longest)
+            masks = torch.zeros(len(crops), longest)
+            for j, c in enumerate(crops):
+                waveforms[j, :, :c.shape[1]] = c
+                masks[j, :c.shape[1]] = 1.
+            with torch.no_grad():
+                embeddings[batch] = model(waveforms, masks=masks)
+        return embeddings
 
-        #diarize our loaded audio file - this is where the heavy computing work happens
-        print("diarization started:", time.strftime("%H:%M:%S", time.localtime()))
-        print(self.AUDIO_FILE)
-        dia = pipeline(self.AUDIO_FILE)
-        print("diarization finished:", time.strftime("%H:%M:%S", time.localtime()))
-        assert isinstance(dia, Annotation)
+    #key for cached results: hash of the audio content and the identity of the models that produced them
+    @staticmethod
+    def cache_key(file):
+        key = hashlib.sha1()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                key.update(block)
+        key.update(f"{PIPELINE_MODEL}|{EMBEDDING_MODEL}|{pyannote.audio.__version__}".encode())
+        return key.hexdigest()
 
-        #iterate through recognized speaker changes and clean up
+    #read the cached annotation (.rttm) and segment embeddings (.embeddings.npz) of a file, if they match its key
+    @staticmethod
+    def load_cache(file, key):
+        dia = embeddings = None
+        rttm = Path(file).with_suffix(".rttm")
+        if rttm.exists():
+            dia = Annotation(uri=key)
+            with open(rttm, "r") as f:
+                for track, line in enumerate(f):
+                    fields = line.split()
+                    if len(fields) < 8 or fields[0] != "SPEAKER" or fields[1] != key:
+                        dia = None
+                        break
+                    dia[Segment(float(fields[3]), float(fields[3]) + float(fields[4])), track] = fields[7]
+            if dia is not None and len(dia) == 0:
+                dia = None
+        cached = Path(file).with_suffix(".embeddings.npz")
+        if dia is not None and cached.exists():
+            with numpy.load(cached) as loaded:
+                if str(loaded["key"]) == key:
+                    embeddings = loaded["embeddings"]
+        return dia, embeddings
+
+    @staticmethod
+    def save_cache(file, dia, embeddings):
+        with open(Path(file).with_suffix(".rttm"), "w") as f:
+            dia.write_rttm(f)
+        numpy.savez(Path(file).with_suffix(".embeddings.npz"), key=dia.uri, embeddings=embeddings)
+
+    #consolidate the raw annotation into speaker changes and collect the segment used for identifying each turn
+    def consolidate(self, dia):
+        turns = []
         for speech_turn, track, speaker in dia.itertracks(yield_label=True):
-            print(speech_turn)
-            print(track)
-            print(speaker)
             #if measured duration is below one second we just ignore it
             if speech_turn.end - speech_turn.start < 1.:
                 continue
@@ -106,43 +196,151 @@ class diarize:
                 endtime = speech_turn.end
             #if we have a speaker change, consolidate the last segment and start the new one
             if speaker != self.lastspeaker:
-                # extract embedding for last speaker segment
-                waveform1, sample_rate = audio.crop(self.AUDIO_FILE, lastident)
-                lastembedding = model(waveform1[None])
-                self.speakers = self.measuredistance(self.speakers, lastembedding, self.lastspeaker)
+                turns.append((lastident, self.lastspeaker))
                 self.speakerchanges.append({"start": starttime, "end": endtime, "speaker": self.lastspeaker, "confidence": 100})
                 starttime = speech_turn.start
                 endtime = speech_turn.end
                 self.lastspeaker = speaker
-                if speaker not in [i["name"] for i in self.speakers["identified"]]:
+                if speaker not in self.speakers["identified"]:
                     self.speakers = self.addspeaker(self.speakers, speaker)
                 lastident = Segment(speech_turn.start, speech_turn.end)
+        if self.lastspeaker != "none":
+            turns.append((lastident, self.lastspeaker))
+            self.speakerchanges.append({"start": starttime, "end": endtime, "speaker": self.lastspeaker, "confidence": 100})
+        return turns
 
-        # extract embedding for last speaker segment
-        try:
-            self.speakers = self.measuredistance(self.speakers, lastembedding, self.lastspeaker)
-        except NameError:
-            waveform1, sample_rate = audio.crop(self.AUDIO_FILE, lastident)
-            lastembedding = model(waveform1[None])
-            self.speakers = self.measuredistance(self.speakers, lastembedding, self.lastspeaker)
-        self.speakerchanges.append({"start": starttime, "end": endtime, "speaker": self.lastspeaker})
-
-        #sort identification counts and replace generic speaker strings with top name and confidence
-        for i in self.speakers["identified"]:
-            name = i.pop("name")
-            newi = dict(sorted(i.items(), key=lambda item: item[1], reverse=True))
+    #raise the identification counters with all turn embeddings and replace generic speaker strings
+    #with the name with most votes, its confidence and all votes
+    def identify(self, turns, embeddings):
+        self.speakers = self.measuredistance(self.speakers, embeddings, [speaker for segment, speaker in turns])
+        for label, counts in self.speakers["identified"].items():
             for single in self.speakerchanges:
-                if single["speaker"] == name:
-                    single["speaker"] = str(list(newi.keys())[0])
-                    single["confidence"] = (100*list(newi.values())[0]) // sum(newi.values())
+                if single["speaker"] == label:
+                    self.label_turn(single, counts)
+
+    #name, confidence and votes of a speaker from the votes collected for them so far
+    def label_turn(self, turn, counts):
+        names = self.index.names + ["???"]
+        top = int(numpy.argmax(counts))
+        turn["speaker"] = names[top]
+        turn["confidence"] = int((100*counts[top]) // max(counts.sum(), 1))
+        turn["votes"] = {names[i]: int(c) for i, c in enumerate(counts) if c > 0}
+        return turn
+
+    #diarize fixed windows one after another, reading only the current window from disk
+    #local speaker labels are linked across windows through running centroids of their embeddings,
+    #and speaker changes are yielded as soon as the next turn of another speaker has started
+    def stream_diarization(self, file=None, window=WINDOW):
+        if file is not None:
+            self.AUDIO_FILE = file
+        self.index = load_index(self.speakers_dir)
+        pipeline, model = self.pipeline, self.model
+        audio = Audio(sample_rate=model.sample_rate, mono=True)
+        duration = audio.get_duration(self.AUDIO_FILE)
+
+        sums = numpy.zeros((0, model.dimension), dtype=numpy.float32)
+        votes = []
+        pending = None
+        print("streaming diarization started:", time.strftime("%H:%M:%S", time.localtime()))
+        for start in numpy.arange(0., duration, window):
+            chunk = Segment(float(start), min(float(start) + window, duration))
+            if chunk.duration < 1.:
+                continue
+            waveform, sample_rate = audio.crop(self.AUDIO_FILE, chunk)
+            dia = pipeline({"waveform": waveform, "sample_rate": sample_rate})
+            local = [(turn, label) for turn, track, label in dia.itertracks(yield_label=True) if turn.duration >= 1.]
+            if len(local) == 0:
+                continue
+            embeddings = SpeakerIndex.normalize(self.embed_segments(model, waveform, sample_rate, [turn for turn, label in local]))
+
+            #link every local speaker to the closest running centroid, or start a new global speaker
+            mapping = {}
+            for label in dict.fromkeys(label for turn, label in local):
+                rows = [i for i, (turn, l) in enumerate(local) if l == label]
+                mean = SpeakerIndex.normalize(embeddings[rows].mean(axis=0, keepdims=True))[0]
+                similarities = SpeakerIndex.normalize(sums) @ mean if len(sums) > 0 else numpy.zeros(0)
+                if len(similarities) > 0 and similarities.max() >= 1. - LINK_DISTANCE:
+                    mapping[label] = int(numpy.argmax(similarities))
+                else:
+                    mapping[label] = len(sums)
+                    sums = numpy.vstack([sums, numpy.zeros((1, model.dimension), dtype=numpy.float32)])
+                    votes.append(numpy.zeros(len(self.index) + 1, dtype=numpy.int64))
+                sums[mapping[label]] += embeddings[rows].sum(axis=0)
+
+            for (turn, label), counts in zip(local, self.index.votes(embeddings)):
+                votes[mapping[label]] += counts
+            for turn, label in local:
+                speaker = mapping[label]
+                if pending is not None and pending["speaker"] == speaker:
+                    pending["end"] = chunk.start + turn.end
+                    continue
+                if pending is not None:
+                    yield self.label_turn(pending, votes[pending["speaker"]])
+                pending = {"start": chunk.start + turn.start, "end": chunk.start + turn.end, "speaker": speaker}
+        if pending is not None:
+            yield self.label_turn(pending, votes[pending["speaker"]])
+        print("streaming diarization finished:", time.strftime("%H:%M:%S", time.localtime()))
+
+    def do_diarization(self, file=None, use_cache=True, cache_file=None):
+        #the same object can diarize one file after another, so start with a clean state
+        if file is not None:
+            self.AUDIO_FILE = file
+            self.CACHE_FILE = cache_file
+        cache_file = self.CACHE_FILE if self.CACHE_FILE is not None else self.AUDIO_FILE
+        self.index = load_index(self.speakers_dir)
+        self.speakers = {"identified": {}}
+        self.lastspeaker = "none"
+        self.speakerchanges = []
+
+        #define variables for pyannote
+        pipeline, model = self.pipeline, self.model
+        audio = Audio(sample_rate=model.sample_rate, mono=True)
+        waveform = None
+
+        #very long recordings would not fit into memory at once
+        if audio.get_duration(self.AUDIO_FILE) > STREAM_AFTER:
+            self.speakerchanges = list(self.stream_diarization())
+            return self.speakerchanges
+
+        #reuse annotation and embeddings of an earlier run on the same audio, then only identification is redone
+        key = self.cache_key(self.AUDIO_FILE)
+        dia, embeddings = self.load_cache(cache_file, key) if use_cache else (None, None)
+        if dia is None:
+            #decode the audio file once and keep it in memory for the pipeline and all embedding crops
+            waveform, sample_rate = audio(self.AUDIO_FILE)
+
+            #diarize our loaded audio file - this is where the heavy computing work happens
+            print("diarization started:", time.strftime("%H:%M:%S", time.localtime()))
+            print(self.AUDIO_FILE)
+            dia = pipeline({"waveform": waveform, "sample_rate": sample_rate})
+            print("diarization finished:", time.strftime("%H:%M:%S", time.localtime()))
+            assert isinstance(dia, Annotation)
+            dia.uri = key
+        else:
+            print("using cached diarization for", self.AUDIO_FILE)
+
+        #iterate through recognized speaker changes and clean up
+        turns = self.consolidate(dia)
+        #nobody spoke long enough to be identified
+        if len(turns) == 0:
+            return self.speakerchanges
+
+        #extract embeddings for all consolidated segments at once
+        if embeddings is None or len(embeddings) != len(turns):
+            if waveform is None:
+                waveform, sample_rate = audio(self.AUDIO_FILE)
+            embeddings = self.embed_segments(model, waveform, sample_rate, [segment for segment, speaker in turns])
+            if use_cache:
+                self.save_cache(cache_file, dia, embeddings)
+
+        self.identify(turns, embeddings)
         return self.speakerchanges
 
 
 if __name__ == '__main__':
 
-    todo = diarize(sys.argv[1])
-    result = todo.do_diarization()
-    for line in result: print(line)
-    printable = todo.make_readable_list(result)
-    for line in printable: print(line)
-
+    todo = diarize()
+    for file, result in diarize_many(sys.argv[1:]):
+        for line in result: print(line)
+        printable = todo.make_readable_list(result)
+        for line in printable: print(line)
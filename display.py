@@ -1,11 +1,20 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from pathlib import Path
 from st_aggrid import AgGrid
 from ast import literal_eval
+import pyarrow.parquet as pq
+from bisect import bisect_left
+import pickle
+import json
 import os
 import glob
 import re
+import searchindex
+
+#columns that can be searched through the filter inputs
+SEARCH_FIELDS = ['title_x', 'description', 'keywords']
 
 def find_channel(lst, key, value):
     for i, dic in enumerate(lst):
@@ -25,6 +34,133 @@ def cleanup_tags(tag_string):
     new_string = ', '.join([i for i in tag_list])
     return new_string
 
+def tokenize(text):
+    return re.findall(r'\w+', str(text).lower())
+
+#build an inverted index per search field: sorted vocabulary and the sorted row ids of every token
+def build_index(imported):
+    index = {}
+    for field in SEARCH_FIELDS:
+        if field not in imported:
+            continue
+        postings = {}
+        for row, text in enumerate(imported[field].fillna('')):
+            for token in set(tokenize(text)):
+                postings.setdefault(token, []).append(row)
+        vocab = sorted(postings)
+        index[field] = (vocab, [np.array(postings[token], dtype=np.int32) for token in vocab])
+    return index
+
+#narrow down row ids to those whose field contains every query word as a word prefix
+def search_index(index, field, query, rows):
+    if field not in index:
+        return rows
+    vocab, postings = index[field]
+    for token in tokenize(query):
+        start = bisect_left(vocab, token)
+        end = bisect_left(vocab, token + '\uffff')
+        if end == start:
+            return np.array([], dtype=np.int32)
+        rows = np.intersect1d(rows, np.unique(np.concatenate(postings[start:end])), assume_unique=True)
+    return rows
+
+#merge a channel's csvs, clean them up and store the result as parquet in the cache folder
+#the parquet file is only rebuilt when one of the csvs is newer than it, edits from the grid are laid over it by load_edited
+def ingest_channel(csvfile, mergecsv=None):
+    cachefolder = Path(csvfile).parent / ".cache"
+    table = cachefolder / (Path(csvfile).stem + ".parquet")
+    #edit logs used to be kept in the cache folder, they belong next to the csv
+    if (cachefolder / (Path(csvfile).stem + ".edits")).exists() and not edits_file(csvfile).exists():
+        (cachefolder / (Path(csvfile).stem + ".edits")).replace(edits_file(csvfile))
+    sources = [csvfile] + ([mergecsv] if mergecsv else [])
+    if table.exists() and table.with_suffix(".index").exists() and table.stat().st_mtime >= max(os.path.getmtime(source) for source in sources):
+        return table
+
+    with open(csvfile, 'r', encoding='utf-8') as csv:
+        imported = pd.read_csv(csv, encoding='utf-8')
+    if mergecsv:
+        with open(mergecsv, 'r', encoding='utf-8') as csv2:
+            imported2 = pd.read_csv(csv2, encoding='utf-8')
+            imported = pd.merge(imported, imported2, on='id', sort=False, how="left", validate="one_to_one")
+
+    #filter/drop some stuff before displaying
+    try:
+        imported = imported.drop(['yt_caption_tracks', 'vid_info'], axis=1)
+        imported.loc[imported['yt_caption_info'].str.contains('a.de', na= False), 'yt_caption_info'] = 'auto de'
+        imported.loc[imported['yt_caption_info'].str.contains('a.en', na= False), 'yt_caption_info'] = 'auto en'
+        imported.loc[imported['yt_caption_info'].str.contains('a.it', na= False), 'yt_caption_info'] = 'auto it'
+        imported.loc[imported['yt_caption_info'].str.contains('a.vi', na= False), 'yt_caption_info'] = 'auto vi'
+        imported.loc[imported['yt_caption_info'].str.contains('{}', na= False), 'yt_caption_info'] = ''
+        imported.loc[imported['description'].str.contains('<NA>', na= True), 'description'] = ''
+        #imported['keywords'] = imported['keywords'].str.replace(r'\[\'\]', '')
+    except:
+        egal = 'egal'
+
+    #convert seconds to min:sek format, clean up keywords
+    imported['length'] = imported['length'].apply(convert_time)
+    imported['keywords'] = imported['keywords'].apply(cleanup_tags)
+
+    cachefolder.mkdir(exist_ok=True)
+    imported.to_parquet(table, index=False)
+    with open(table.with_suffix(".index"), 'wb') as f:
+        pickle.dump(build_index(imported), f)
+    return table
+
+#read only the columns the grid shows, reruns with the same table and mtime come from memory
+@st.experimental_memo
+def load_table(table, mtime, columns):
+    available = pq.read_schema(table).names
+    return pd.read_parquet(table, columns=[c for c in columns if c in available])
+
+#the table with the edits from the grid laid over it, they win over the csvs so sorting sees them too
+#only reruns after a new edit apply the log again, the parquet file and the index stay as they are
+@st.experimental_memo
+def load_edited(table, mtime, columns, log, logmtime):
+    imported = load_table(table, mtime, columns).copy()
+    ids = imported['id'].astype(str)
+    for (row_id, field), value in load_edits(log).items():
+        if field not in imported:
+            continue
+        if imported[field].dtype != object:
+            try:
+                value = imported[field].dtype.type(value)
+            except (TypeError, ValueError):
+                imported[field] = imported[field].astype(object)
+        imported.loc[ids == row_id, field] = value
+    return imported
+
+#row positions of the whole table sorted by one column, computed once per table, edit log, column and direction
+@st.experimental_memo
+def sort_order(table, mtime, columns, log, logmtime, column, ascending):
+    values = load_edited(table, mtime, columns, log, logmtime)[column]
+    if values.dtype == object:
+        values = values.fillna('').astype(str)
+    return values.reset_index(drop=True).sort_values(ascending=ascending, kind='stable').index.to_numpy()
+
+#edits made in the grid, appended to a log next to the channel's csv as one json line per changed cell
+#it is the only copy of them, so it lives outside the disposable cache folder
+def edits_file(csvfile):
+    return Path(csvfile).with_suffix(".edits")
+
+def load_edits(log):
+    edits = {}
+    if Path(log).exists():
+        with open(log, 'r', encoding='utf-8') as f:
+            for line in f:
+                edit = json.loads(line)
+                edits[(edit["id"], edit["field"])] = edit["value"]
+    return edits
+
+def write_edits(log, changes):
+    with open(log, 'a', encoding='utf-8') as f:
+        for row_id, field, value in changes:
+            f.write(json.dumps({"id": row_id, "field": field, "value": value}, ensure_ascii=False) + "\n")
+
+@st.experimental_memo
+def load_index(table, mtime):
+    with open(Path(table).with_suffix(".index"), 'rb') as f:
+        return pickle.load(f)
+
 #define aggrid styling
 grid_options = {
     "columnDefs": [
@@ -173,43 +309,66 @@ with col2:
 with col3:
     descriptionfilter = st.text_input('Beschreibungssuche', '')
 
-with open(all_csvs[chosen_csv], 'r', encoding='utf-8') as csv:
-    imported = pd.read_csv(csv, encoding='utf-8')
-    current_index = [*all_csvs].index(chosen_csv)
-    if "merge" in [*all_csvs][current_index+1]:
-
-        with open(list(all_csvs.values())[current_index+1], 'r', encoding='utf-8') as csv2:
-            imported2 = pd.read_csv(csv2, encoding='utf-8')
-            imported = pd.merge(imported, imported2, on='id', sort=False, how="left", validate="one_to_one")
+current_index = [*all_csvs].index(chosen_csv)
+mergecsv = None
+if current_index + 1 < len(all_csvs) and "merge" in [*all_csvs][current_index+1]:
+    mergecsv = list(all_csvs.values())[current_index+1]
+table = ingest_channel(all_csvs[chosen_csv], mergecsv)
+log = edits_file(all_csvs[chosen_csv])
+logmtime = log.stat().st_mtime if log.exists() else 0
+gridcolumns = tuple(column["field"] for column in grid_options["columnDefs"])
+imported = load_edited(str(table), table.stat().st_mtime, gridcolumns, str(log), logmtime)
 
 st.write('### ', chosen_csv)
 
-#filter/drop some stuff before displaying
-try:
-    imported = imported.drop(['yt_caption_tracks', 'vid_info'], axis=1)
-    imported.loc[imported['yt_caption_info'].str.contains('a.de', na= False), 'yt_caption_info'] = 'auto de'
-    imported.loc[imported['yt_caption_info'].str.contains('a.en', na= False), 'yt_caption_info'] = 'auto en'
-    imported.loc[imported['yt_caption_info'].str.contains('a.it', na= False), 'yt_caption_info'] = 'auto it'
-    imported.loc[imported['yt_caption_info'].str.contains('a.vi', na= False), 'yt_caption_info'] = 'auto vi'
-    imported.loc[imported['yt_caption_info'].str.contains('{}', na= False), 'yt_caption_info'] = ''
-    imported.loc[imported['description'].str.contains('<NA>', na= True), 'description'] = ''
-    #imported['keywords'] = imported['keywords'].str.replace(r'\[\'\]', '')
-except:
-    egal = 'egal'
-
-#convert seconds to min:sek format, clean up keywords
-imported['length'] = imported['length'].apply(convert_time)
-imported['keywords'] = imported['keywords'].apply(cleanup_tags)
-
-#apply user filters and render table
-try:
-    filt1 = imported['title_x'].str.contains(titlefilter, na= False)
-    filt2 = imported['description'].str.contains(descriptionfilter, na= False)
-    filt3 = imported['keywords'].str.contains(tagfilter, na= False)
-    imported_filt = imported.loc[filt1 & filt2 & filt3]
-except:
-    imported_filt = imported
-
-AgGrid(imported_filt, grid_options, editable=True, fit_columns_on_grid_load=True)
+#apply user filters through the inverted index
+index = load_index(str(table), table.stat().st_mtime)
+rows = np.arange(len(imported), dtype=np.int32)
+for field, query in zip(SEARCH_FIELDS, [titlefilter, descriptionfilter, tagfilter]):
+    rows = search_index(index, field, query, rows)
+
+#sort and page on the server, so only the visible rows are sent to the grid
+columns = {column["headerName"]: column["field"] for column in grid_options["columnDefs"] if column["field"] in imported}
+editable = [column["field"] for column in grid_options["columnDefs"] if column.get("editable") and column["field"] in imported]
+col1, col2, col3, col4 = st.columns(4)
+with col1:
+    sortby = st.selectbox('Sortierung', [*columns])
+with col2:
+    ascending = st.checkbox('aufsteigend', True)
+with col3:
+    pagesize = st.selectbox('Zeilen pro Seite', [50, 100, 250, 1000])
+pages = max(1, -(-len(rows) // pagesize))
+with col4:
+    page = st.number_input(f'Seite (von {pages})', min_value=1, max_value=pages, value=1)
+order = sort_order(str(table), table.stat().st_mtime, gridcolumns, str(log), logmtime, columns[sortby], ascending)
+order = order[np.isin(order, rows)]
+imported_filt = imported.iloc[order[(page - 1) * pagesize : page * pagesize]].copy()
+st.write(f"{len(rows)} von {len(imported)} Videos")
+
+response = AgGrid(imported_filt, grid_options, editable=True, fit_columns_on_grid_load=True)
 
+#write back only the cells that were changed in the grid, matched by id as the grid may send back other rows or another order
+before = imported_filt[['id'] + editable].astype({'id': str})
+after = response['data'][[field for field in ['id'] + editable if field in response['data']]].astype({'id': str})
+compared = before.merge(after, on='id', how='inner', suffixes=('_before', '_after'))
+changes = []
+for field in editable:
+    if field + '_after' not in compared:
+        continue
+    old = compared[field + '_before'].fillna('').astype(str).to_numpy()
+    new = compared[field + '_after'].fillna('').astype(str).to_numpy()
+    for i in np.flatnonzero(old != new):
+        changes.append((compared['id'].iloc[i], field, new[i]))
+if changes:
+    #shown on the next run, as the log is now newer than what load_edited remembers
+    write_edits(log, changes)
 
+#search through all indexed transcripts
+st.write('### Transkripte')
+transcriptfilter = st.text_input('Transkriptsuche', '')
+if transcriptfilter:
+    connection = searchindex.connect()
+    hits = searchindex.search(connection, transcriptfilter, 500)
+    connection.close()
+    st.write(f"{len(hits)} Treffer")
+    st.dataframe(pd.DataFrame([{"Datei": media, "Zeit": f"{start // 60000:02d}:{start // 1000 % 60:02d}", "ms": start, "Text": text} for media, start, end, text in hits]))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import sqlite3
+import subprocess
+import numpy
+from pathlib import Path
+
+#where fingerprints of transcribed media are kept, can be changed with the VOSKRIBE_FINGERPRINTS environment variable
+FINGERPRINT_FILE = Path(os.environ.get("VOSKRIBE_FINGERPRINTS", Path.cwd() / "voskribe-fingerprints.sqlite"))
+#decoded samples used for fingerprinting: seconds from the start (and as many around the middle of longer files) and sample rate
+SAMPLE_SECONDS = 30
+SAMPLE_RATE = 8000
+#frames of 100 ms every 50 ms, energies in 17 bands between 300 and 3000 Hz give 16 bits per frame
+FRAME = 800
+HOP = 400
+BANDS = numpy.geomspace(300, 3000, 18)
+#frames kept of the first sample, so the one around the middle always starts at the same row
+WINDOW_FRAMES = (SAMPLE_SECONDS * SAMPLE_RATE - FRAME) // HOP - 1
+#the middle of two files within MAX_DURATION_DIFFERENCE of each other can be this many frames apart
+MIDDLE_SHIFT = 14
+#frames quieter than this (dB below full scale) count as silence, a fingerprint needs at least MIN_SOUND of its frames
+#above it and between MIN_SET_BITS and 1 - MIN_SET_BITS of its bits set, else it tells too little about the audio to match on
+SILENCE_DB = -50.
+MIN_SOUND = 0.5
+MIN_SET_BITS = 0.2
+#maximum share of differing bits and of duration difference (in seconds) for two files to count as the same audio
+MAX_BIT_ERRORS = 0.2
+MAX_DURATION_DIFFERENCE = 1.
+#outputs of a transcription that are reused for a duplicate
+OUTPUT_SUFFIXES = [".srt", ".transcript", ".words.npy", ".words.txt"]
+
+
+# function to get the duration of a media file in seconds with ffprobe
+def duration(file):
+    out = subprocess.run(["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", str(file)],
+                         capture_output=True, text=True).stdout.strip()
+    return float(out) if out not in ["", "N/A"] else 0.
+
+
+# function to compute the bits of SAMPLE_SECONDS of decoded audio from offset on, and which of their frames are not silent
+# every bit tells whether the energy difference of two neighbouring bands grew or shrank since the last frame
+def window(file, offset=0.):
+    pcm = subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-ss", str(offset), "-t", str(SAMPLE_SECONDS), "-i", str(file),
+                          "-ac", "1", "-ar", str(SAMPLE_RATE), "-f", "s16le", "-"], capture_output=True).stdout
+    samples = numpy.frombuffer(pcm, dtype=numpy.int16).astype(numpy.float32)
+    if len(samples) < FRAME * 2:
+        return numpy.zeros((0, len(BANDS) - 2), dtype=bool), numpy.zeros(0, dtype=bool)
+    frames = numpy.lib.stride_tricks.sliding_window_view(samples, FRAME)[::HOP]
+    sound = 10 * numpy.log10(numpy.mean((frames / 32768) ** 2, axis=1) + 1e-12) > SILENCE_DB
+    spectrum = numpy.abs(numpy.fft.rfft(frames * numpy.hanning(FRAME), axis=1)) ** 2
+    bins = numpy.fft.rfftfreq(FRAME, 1 / SAMPLE_RATE)
+    energies = numpy.stack([spectrum[:, (bins >= lo) & (bins < hi)].sum(axis=1) for lo, hi in zip(BANDS[:-1], BANDS[1:])], axis=1)
+    differences = numpy.diff(numpy.log(energies + 1e-6), axis=1)
+    return numpy.diff(differences, axis=0) > 0, sound[1:]
+
+
+# function to compute a fingerprint from the first seconds of decoded audio and, for longer files, the seconds around the middle,
+# robust to container, codec and bitrate; empty if the audio is mostly silent or its bits hardly change
+def compute(file, seconds=None):
+    seconds = duration(file) if seconds is None else seconds
+    bits, sound = window(file)
+    bits, sound = bits[:WINDOW_FRAMES], sound[:WINDOW_FRAMES]
+    #a longer file with the same start, e.g. a recording with the same intro, differs around its middle
+    if seconds > SAMPLE_SECONDS * 2 and len(bits) == WINDOW_FRAMES:
+        middle, middlesound = window(file, seconds / 2 - SAMPLE_SECONDS / 2)
+        bits, sound = numpy.concatenate([bits, middle]), numpy.concatenate([sound, middlesound])
+    if len(bits) == 0 or numpy.mean(sound) < MIN_SOUND or not MIN_SET_BITS <= numpy.mean(bits) <= 1 - MIN_SET_BITS:
+        return numpy.zeros((0, len(BANDS) - 2), dtype=bool)
+    return bits
+
+
+# function to split a fingerprint into the bits of its first sample and of the one around the middle, if it has one
+def windows(bits):
+    return [bits[:WINDOW_FRAMES], bits[WINDOW_FRAMES:]] if len(bits) > WINDOW_FRAMES else [bits]
+
+
+# function to compare two fingerprints, allowing a few frames of offset between decoders
+def bit_errors(a, b, max_shift=4):
+    best = 1.
+    for shift in range(-max_shift, max_shift + 1):
+        x = a[max(shift, 0):]
+        y = b[max(-shift, 0):]
+        n = min(len(x), len(y))
+        if n > 0:
+            best = min(best, float(numpy.mean(x[:n] != y[:n])))
+    return best
+
+
+def connect(fingerprintfile=None):
+    connection = sqlite3.connect(str(fingerprintfile if fingerprintfile is not None else FINGERPRINT_FILE))
+    connection.execute("CREATE TABLE IF NOT EXISTS fingerprints (base TEXT PRIMARY KEY, duration REAL, frames INTEGER, bits BLOB)")
+    connection.execute("CREATE INDEX IF NOT EXISTS fingerprints_duration ON fingerprints (duration)")
+    return connection
+
+
+# function to remember the fingerprint of a transcribed file, base is its path without suffix, shared by all its outputs
+def remember(connection, base, seconds, bits):
+    with connection:
+        connection.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?)",
+                           (str(base), seconds, len(bits), numpy.packbits(bits).tobytes()))
+
+
+# function to find an already transcribed file with the same audio, returns its base path or None
+def find(connection, seconds, bits, exclude=None):
+    rows = connection.execute("SELECT base, frames, bits FROM fingerprints WHERE duration BETWEEN ? AND ?",
+                              (seconds - MAX_DURATION_DIFFERENCE, seconds + MAX_DURATION_DIFFERENCE)).fetchall()
+    for base, frames, blob in rows:
+        if base == str(exclude) or not all(Path(base + s).exists() for s in OUTPUT_SUFFIXES[:2]):
+            continue
+        known = numpy.unpackbits(numpy.frombuffer(blob, dtype=numpy.uint8))[:frames * bits.shape[1]].reshape(frames, bits.shape[1]).astype(bool)
+        if same(known, bits):
+            return Path(base)
+    return None
+
+
+# function to tell whether two fingerprints are of the same audio,
+# both samples have to match, the middle ones may be a little further apart if the durations differ
+def same(a, b):
+    return all(bit_errors(x, y, 4 if i == 0 else MIDDLE_SHIFT) <= MAX_BIT_ERRORS for i, (x, y) in enumerate(zip(windows(a), windows(b))))
+
+
+# function to give a duplicate the outputs of the original, as hard links where the file system allows it
+def link_outputs(original, base):
+    for suffix in OUTPUT_SUFFIXES:
+        source = Path(str(original) + suffix)
+        target = Path(str(base) + suffix)
+        if not source.exists() or target.exists():
+            continue
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copy2(source, target)
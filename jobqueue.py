@@ -0,0 +1,179 @@
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+#where the queue of media files to transcribe is kept, can be changed with the VOSKRIBE_QUEUE environment variable
+QUEUE_FILE = Path(os.environ.get("VOSKRIBE_QUEUE", Path.cwd() / "voskribe-queue.sqlite"))
+#how often a file leased through a LeaseStore is tried before it is given up on, a ttl apart
+LEASE_ATTEMPTS = int(os.environ.get("VOSKRIBE_LEASE_ATTEMPTS", 3))
+
+
+# persistent queue of media files, every job is one row that goes from queued to running to done or failed
+class JobQueue:
+
+    def __init__(self, queuefile=None):
+        self.queuefile = Path(queuefile) if queuefile is not None else QUEUE_FILE
+        #autocommit mode, transactions are opened explicitly where several statements belong together
+        self.connection = sqlite3.connect(str(self.queuefile), timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (path TEXT PRIMARY KEY, state TEXT, size INTEGER, mtime REAL,
+                added REAL, started REAL, finished REAL, worker TEXT, attempts INTEGER DEFAULT 0, error TEXT)""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, added)")
+
+    # function to check whether a file is already queued or transcribed in exactly this version
+    def known(self, path, size, mtime):
+        row = self.connection.execute("SELECT size, mtime FROM jobs WHERE path = ?", (str(path),)).fetchone()
+        return row is not None and row[0] == size and row[1] == mtime
+
+    # function to queue a file, a file that is already known is only queued again if it changed since
+    def add(self, path, size, mtime):
+        if self.known(path, size, mtime):
+            return False
+        self.connection.execute("""INSERT OR REPLACE INTO jobs (path, state, size, mtime, added, attempts)
+            VALUES (?, 'queued', ?, ?, ?, 0)""", (str(path), size, mtime, time.time()))
+        return True
+
+    # function to take the oldest queued job, returns its path or None
+    def claim(self, worker):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute("SELECT path FROM jobs WHERE state = 'queued' ORDER BY added LIMIT 1").fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE jobs SET state = 'running', started = ?, worker = ?, attempts = attempts + 1 WHERE path = ?",
+                    (time.time(), worker, row[0]))
+            self.connection.execute("COMMIT")
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        return Path(row[0]) if row is not None else None
+
+    def done(self, path):
+        self.connection.execute("UPDATE jobs SET state = 'done', finished = ?, error = NULL WHERE path = ?", (time.time(), str(path)))
+
+    def fail(self, path, error):
+        self.connection.execute("UPDATE jobs SET state = 'failed', finished = ?, error = ? WHERE path = ?", (time.time(), str(error), str(path)))
+
+    # function to queue jobs again that were running when the daemon stopped
+    def recover(self):
+        return self.connection.execute("UPDATE jobs SET state = 'queued' WHERE state = 'running'").rowcount
+
+    def counts(self):
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+# leases on media files in a directory shared by several hosts (e.g. on NFS), one file per media file
+# creating a lease is atomic (O_EXCL), its mtime is renewed while the job runs, and an expired lease is
+# taken over by renaming it away first; whoever renamed away a lease that was not the expired one any more puts it back
+# a failed file is tried again a ttl later, up to attempts times; deleting its .failed marker gives it new attempts
+class LeaseStore:
+
+    def __init__(self, directory, ttl=600., owner=None, attempts=LEASE_ATTEMPTS):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.attempts = attempts
+        self.owner = owner if owner is not None else f"{socket.gethostname()}:{os.getpid()}"
+        self.held = set()
+        self.lock = threading.Lock()
+
+    def leasefile(self, path, suffix=".lease"):
+        return self.directory / (hashlib.sha1(str(path).encode()).hexdigest() + suffix)
+
+    # function to get how often a file failed so far and when it failed last
+    def failures(self, path):
+        try:
+            with open(self.leasefile(path, ".failed"), 'r') as f:
+                lines = f.read().split("\n")
+            return int(lines[2]), self.leasefile(path, ".failed").stat().st_mtime
+        except (FileNotFoundError, IndexError, ValueError):
+            return 0, 0.
+
+    # function to check whether a file was finished (or failed for good) by any host
+    def is_done(self, path):
+        return self.leasefile(path, ".done").exists() or self.failures(path)[0] >= self.attempts
+
+    # function to try to take the lease of a file, returns True if we own it now
+    def claim(self, path):
+        #a file that just failed waits a ttl, so a passing NFS or ffmpeg hiccup is over before it is tried again
+        attempts, failed = self.failures(path)
+        if attempts > 0 and time.time() - failed <= self.ttl:
+            return False
+        lease = self.leasefile(path)
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                stat = lease.stat()
+            except FileNotFoundError:
+                return False
+            if time.time() - stat.st_mtime <= self.ttl:
+                return False
+            #the host holding this lease stopped renewing it, try to take it over
+            expiredfile = self.leasefile(path, ".expired." + hashlib.sha1(self.owner.encode()).hexdigest()[:8])
+            try:
+                os.rename(lease, expiredfile)
+            except FileNotFoundError:
+                return False
+            #another host may have taken the lease over between our stat and rename, then we just moved its fresh lease away
+            moved = expiredfile.stat()
+            if moved.st_ino != stat.st_ino or time.time() - moved.st_mtime <= self.ttl:
+                try:
+                    os.link(expiredfile, lease)
+                except FileExistsError:
+                    pass
+                expiredfile.unlink(missing_ok=True)
+                return False
+            expiredfile.unlink(missing_ok=True)
+            return self.claim(path)
+        with os.fdopen(fd, 'w') as f:
+            f.write(f"{self.owner}\n{path}\n")
+        #make sure nobody renamed our lease away in the meantime, believing it expired
+        try:
+            with open(lease, 'r') as f:
+                if f.readline().strip() != self.owner:
+                    return False
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            self.held.add(path)
+        return True
+
+    # function to give up a lease, leaving a marker when the file is finished or failed (counting its attempts)
+    def release(self, path, done=True, error=None):
+        with self.lock:
+            self.held.discard(path)
+        if error is not None:
+            attempts = self.failures(path)[0] + 1
+            with open(self.leasefile(path, ".failed"), 'w') as f:
+                f.write(f"{self.owner}\n{path}\n{attempts}\n{error}\n")
+        elif done:
+            with open(self.leasefile(path, ".done"), 'w') as f:
+                f.write(f"{self.owner}\n{path}\n")
+            self.leasefile(path, ".failed").unlink(missing_ok=True)
+        self.leasefile(path).unlink(missing_ok=True)
+
+    # function to renew all leases we hold, has to run more often than ttl
+    def renew(self):
+        with self.lock:
+            held = list(self.held)
+        for path in held:
+            try:
+                os.utime(self.leasefile(path))
+            except FileNotFoundError:
+                pass
+
+    # function to renew our leases from a background thread every third of the ttl
+    def start_heartbeat(self):
+        def beat():
+            while True:
+                time.sleep(self.ttl / 3)
+                self.renew()
+        threading.Thread(target=beat, daemon=True).start()
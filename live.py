@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import json
+import argparse
+import datetime
+import subprocess
+import srt
+from pathlib import Path
+import metrics
+
+#bytes per sample of the 16-bit PCM we read
+SAMPLE_WIDTH = 2
+
+
+# function to open the PCM stream: stdin, a named pipe, or a local file that ffmpeg plays back at real-time pace for testing
+def open_stream(source, replay, rate):
+    if replay is not None:
+        ffmpeg = subprocess.Popen(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-re", "-i", str(replay),
+                                   "-ac", "1", "-ar", str(rate), "-f", "s16le", "-"], stdout=subprocess.PIPE)
+        return ffmpeg.stdout
+    if source == "-":
+        return sys.stdin.buffer
+    return open(source, "rb")
+
+
+# function to turn the words of a finalized result into subtitle cues, punctuated if there is a punctuation model
+# the whole utterance is punctuated at once, cue by cue every cue would become a sentence of its own
+def make_cues(words, index, punctuate, words_per_line):
+    tokens = punctuate(" ".join(w['word'] for w in words)).split()
+    if len(tokens) != len(words):
+        #recasepunc gave back a different number of words, keep them unpunctuated rather than misaligned
+        tokens = [w['word'] for w in words]
+    cues = []
+    for j in range(0, len(words), words_per_line):
+        line = words[j:j + words_per_line]
+        cues.append(srt.Subtitle(index=index + len(cues),
+            content=" ".join(tokens[j:j + words_per_line]),
+            start=datetime.timedelta(seconds=line[0]['start']),
+            end=datetime.timedelta(seconds=line[-1]['end'])))
+    return cues
+
+
+def main():
+    parser = argparse.ArgumentParser(description="live captions from a raw 16-bit mono PCM stream, e.g. "
+                                     "ffmpeg -i rtmp://... -ac 1 -ar 16000 -f s16le - | live.py --model MODEL")
+    parser.add_argument("source", help="named pipe to read PCM from, - for stdin", nargs='?', default="-")
+    parser.add_argument("--model", help="vosk model directory", required=True, type=Path)
+    parser.add_argument("--punctuation", help="recasepunc model directory", default=None, type=Path)
+    parser.add_argument("--rate", help="sample rate of the stream", default=16000, type=int)
+    parser.add_argument("--chunk", help="milliseconds of audio fed to the recognizer at once", default=200, type=int)
+    parser.add_argument("--max-utterance", help="seconds after which a cue is finalized even without a pause", default=10., type=float)
+    parser.add_argument("--words-per-line", help="maximum words per cue", default=7, type=int)
+    parser.add_argument("--srt", help="also append the finalized cues to this file", default=None, type=Path)
+    parser.add_argument("--replay", help="play a local media file at real-time pace instead of reading a stream, for testing", default=None, type=Path)
+    parser.add_argument("--no-partial", help="do not show partial results", action='store_true')
+    args = parser.parse_args()
+
+    import voskribe
+    voskribe.loadmodels(args.model, args.punctuation)
+    rec = voskribe.KaldiRecognizer(voskribe.model, args.rate)
+    rec.SetWords(True)
+    stream = open_stream(args.source, args.replay, args.rate)
+    out = open(args.srt, 'a') if args.srt is not None else None
+
+    chunkbytes = args.rate * SAMPLE_WIDTH * args.chunk // 1000
+    bytespersecond = args.rate * SAMPLE_WIDTH
+    received = 0
+    finalized = 0.
+    busy = 0.
+    latencies = []
+    index = 1
+    lastpartial = ""
+    started = None
+    metrics.start(args.replay or args.source)
+    try:
+        while True:
+            data = stream.read(chunkbytes)
+            if len(data) == 0:
+                break
+            if started is None:
+                #the wall clock time the stream started at, audio at second t of the stream arrived at started + t
+                started = time.time() - len(data) / bytespersecond
+            received += len(data)
+            t0 = time.perf_counter()
+            with metrics.stage("decode"):
+                final = rec.AcceptWaveform(data)
+                #finalize long utterances without a pause, so no cue waits longer than max-utterance
+                if not final and received / bytespersecond - finalized > args.max_utterance:
+                    result = rec.FinalResult()
+                    final = True
+                elif final:
+                    result = rec.Result()
+                else:
+                    result = rec.PartialResult()
+            if final:
+                words = json.loads(result).get("result", [])
+                finalized = received / bytespersecond
+                if len(words) > 0:
+                    cues = make_cues(words, index, voskribe.punctuate, args.words_per_line)
+                    index += len(cues)
+                    metrics.count("words", len(words))
+                    #latency: from the moment the last word of a cue was spoken until the cue is out
+                    latencies.append(time.time() - (started + words[-1]['end']))
+                    text = srt.compose(cues, reindex=False)
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                    if out is not None:
+                        out.write(text)
+                        out.flush()
+                lastpartial = ""
+            elif not args.no_partial:
+                partial = json.loads(result).get("partial", "")
+                if partial != lastpartial:
+                    print(partial, file=sys.stderr, end='\r', flush=True)
+                    lastpartial = partial
+            busy += time.perf_counter() - t0
+    except KeyboardInterrupt:
+        pass
+    finally:
+        words = json.loads(rec.FinalResult()).get("result", [])
+        if len(words) > 0:
+            text = srt.compose(make_cues(words, index, voskribe.punctuate, args.words_per_line), reindex=False)
+            sys.stdout.write(text)
+            if out is not None:
+                out.write(text)
+        if out is not None:
+            out.close()
+        duration = received / bytespersecond
+        metrics.count("audio_duration", duration)
+        metrics.count("bytes_read", received)
+        metrics.finish()
+        #rtf is the share of the audio's duration we were busy recognizing and punctuating, it has to stay below 1 to keep up
+        print(f"\n{duration:.1f} s of audio, rtf {busy / duration if duration > 0 else 0:.3f}", file=sys.stderr)
+        if len(latencies) > 0:
+            latencies.sort()
+            print(f"cue latency: mean {sum(latencies) / len(latencies):.2f} s, p95 {latencies[int(len(latencies) * .95)]:.2f} s, "
+                  f"max {latencies[-1]:.2f} s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
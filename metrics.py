@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import socket
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    #not available on windows, peak memory is not reported there
+    resource = None
+try:
+    import fcntl
+except ImportError:
+    #not available on windows, processes sharing a textfile there may overwrite each other's lines
+    fcntl = None
+
+#per-file records are appended here as json lines, set VOSKRIBE_METRICS to an empty string to turn this off
+METRICS_FILE = os.environ.get("VOSKRIBE_METRICS", str(Path.cwd() / "voskribe-metrics.jsonl"))
+#optional textfile for the prometheus node exporter's textfile collector, e.g. /var/lib/node_exporter/voskribe.prom
+PROMETHEUS_FILE = os.environ.get("VOSKRIBE_PROMETHEUS", "")
+
+#record of the file each thread is currently working on (several files are in flight when stages are pipelined) and totals of this batch
+local = threading.local()
+totals = {"files": 0, "elapsed": 0., "wall": 0., "audio_duration": 0., "bytes_read": 0, "words": 0, "rtf_max": 0., "stages": {}}
+#finish() runs in several threads of a pipelined batch
+lock = threading.Lock()
+#files in flight and since when at least one was, their union is the wall clock the batch has been working
+inflight = 0
+busysince = 0.
+
+
+# function to get the wall clock time files were in flight, overlapping files counted once
+def elapsed():
+    return totals["elapsed"] + (time.perf_counter() - busysince if inflight > 0 else 0.)
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    #ru_maxrss is in kilobytes on linux, ffmpeg and other children are counted separately
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+# function to start the record of a file, returns it so other threads can take it over with use()
+def start(file):
+    global inflight, busysince
+    with lock:
+        if inflight == 0:
+            busysince = time.perf_counter()
+        inflight += 1
+    local.current = {"file": str(file), "started": time.time(), "wall": 0., "audio_duration": 0., "rtf": None,
+                     "bytes_read": 0, "words": 0, "peak_rss": None, "stages": {}}
+    local.current["_t0"] = time.perf_counter()
+    return local.current
+
+
+# function to make a record the current one of this thread, e.g. when a file moves on to the next pipeline stage
+def use(record):
+    local.current = record
+
+
+# context manager to time a stage of the current file, repeated stages add up
+@contextmanager
+def stage(name):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = getattr(local, "current", None)
+        if current is not None:
+            current["stages"][name] = current["stages"].get(name, 0.) + time.perf_counter() - t0
+
+
+# function to add to a counter of the current file
+def count(name, value):
+    current = getattr(local, "current", None)
+    if current is not None:
+        current[name] += value
+
+
+# function to close the record of the current file and export it
+def finish():
+    record = getattr(local, "current", None)
+    if record is None:
+        return
+    local.current = None
+    #wall includes time spent waiting between pipelined stages, rtf only counts the time the file was worked on
+    record["wall"] = time.perf_counter() - record.pop("_t0")
+    record["busy"] = sum(record["stages"].values())
+    record["rtf"] = record["busy"] / record["audio_duration"] if record["audio_duration"] > 0 else None
+    record["peak_rss"] = peak_rss()
+
+    global inflight
+    with lock:
+        inflight -= 1
+        if inflight == 0:
+            totals["elapsed"] += time.perf_counter() - busysince
+        totals["files"] += 1
+        for key in ["wall", "audio_duration", "bytes_read", "words"]:
+            totals[key] += record[key]
+        totals["rtf_max"] = max(totals["rtf_max"], record["rtf"] or 0.)
+        for name, seconds in record["stages"].items():
+            totals["stages"][name] = totals["stages"].get(name, 0.) + seconds
+
+        if METRICS_FILE:
+            with open(METRICS_FILE, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        if PROMETHEUS_FILE:
+            try:
+                write_prometheus(PROMETHEUS_FILE)
+            except OSError as e:
+                #the file was transcribed all the same, a failed export must not fail it
+                print("Could not write metrics to", PROMETHEUS_FILE, e)
+    return record
+
+
+# function to write the batch totals in prometheus text format, renamed into place so the collector never reads half a file
+# every process labels its samples with worker="host:pid" and keeps the samples of the other workers sharing the file
+def write_prometheus(path):
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    families = [
+        ("voskribe_files_total", "counter", "Media files processed by this batch.", [("", totals['files'])]),
+        ("voskribe_elapsed_seconds_total", "counter", "Wall clock time at least one file was in flight.", [("", f"{elapsed():.3f}")]),
+        ("voskribe_wall_seconds_total", "counter", "Wall time of the files, overlapping ones added up.", [("", f"{totals['wall']:.3f}")]),
+        ("voskribe_audio_seconds_total", "counter", "Duration of the processed audio.", [("", f"{totals['audio_duration']:.3f}")]),
+        ("voskribe_bytes_read_total", "counter", "PCM bytes fed to the recognizer.", [("", totals['bytes_read'])]),
+        ("voskribe_words_total", "counter", "Words recognized.", [("", totals['words'])]),
+        ("voskribe_rtf", "gauge", "Real time factor of the whole batch and of its slowest file.",
+            [(',file="batch"', f"{elapsed() / totals['audio_duration'] if totals['audio_duration'] > 0 else 0:.4f}"),
+             (',file="slowest"', f"{totals['rtf_max']:.4f}")]),
+        ("voskribe_stage_seconds_total", "counter", "Wall time per processing stage.",
+            [(f',stage="{name}"', f"{seconds:.3f}") for name, seconds in totals["stages"].items()]),
+    ]
+    if peak_rss() is not None:
+        families.append(("voskribe_peak_rss_bytes", "gauge", "Peak resident memory.", [("", peak_rss())]))
+
+    with open(path + ".lock", 'a') as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        #samples of the other workers, by metric name
+        others = {}
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.startswith("#") and f'worker="{worker}"' not in line:
+                        others.setdefault(line.split("{")[0].split(" ")[0], []).append(line.rstrip("\n"))
+        except FileNotFoundError:
+            pass
+        lines = []
+        for name, kind, description, samples in families:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            lines += [f'{name}{{worker="{worker}"{labels}}} {value}' for labels, value in samples]
+            lines += others.pop(name, [])
+        temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temporary, path)
@@ -0,0 +1,101 @@
+import os
+import gc
+import json
+import subprocess
+from pathlib import Path
+from collections import OrderedDict
+from vosk import KaldiRecognizer
+
+#how much memory the loaded models may take together, in bytes, can be changed with the VOSKRIBE_MODEL_MEMORY environment variable
+MODEL_MEMORY = int(float(os.environ.get("VOSKRIBE_MODEL_MEMORY", 6e9)))
+#seconds of audio every candidate model listens to when identifying the language of a file
+SAMPLE_SECONDS = 15
+#files are identified in chunks, so every model is loaded once per chunk and only one chunk of samples is held in memory
+CHUNK = 100
+#a model that recognizes fewer words than this in a sample does not get a score
+MIN_WORDS = 3
+
+
+# function to read the language code from the name of a vosk or recasepunc model directory,
+# e.g. vosk-model-small-en-us-0.15, vosk-model-de-0.21 or vosk-recasepunc-de-0.21
+def model_language(path):
+    for part in Path(path).name.lower().split('-'):
+        if part not in ['vosk', 'model', 'small', 'recasepunc'] and part.isalpha() and len(part) in [2, 3]:
+            return part
+    return Path(path).name
+
+
+# function to estimate what a model takes in memory from what it takes on disk
+def model_size(path):
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+# keeps loaded models in least recently used order, dropping the oldest ones when a new one would not fit the memory budget
+class ModelCache:
+
+    def __init__(self, budget=None):
+        self.budget = budget if budget is not None else MODEL_MEMORY
+        self.loaded = OrderedDict()
+
+    def used(self):
+        return sum(size for model, size in self.loaded.values())
+
+    def cached(self, path):
+        return str(path) in self.loaded
+
+    # function to get a model, load(path) is called if it is not loaded yet
+    def get(self, path, load):
+        key = str(path)
+        if key in self.loaded:
+            self.loaded.move_to_end(key)
+            return self.loaded[key][0]
+        size = model_size(path)
+        while len(self.loaded) > 0 and self.used() + size > self.budget:
+            evicted, _ = self.loaded.popitem(last=False)
+            print("Unloading", Path(evicted).name, "to stay within the model memory budget")
+            gc.collect()
+        self.loaded[key] = (load(path), size)
+        return self.loaded[key][0]
+
+
+# function to decode a short sample from a third into the file (skipping intros, at most a minute in) as 16 kHz mono PCM
+def sample(file, duration=0.):
+    offset = min(60., duration / 3) if duration > SAMPLE_SECONDS * 2 else 0.
+    return subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-ss", str(offset), "-t", str(SAMPLE_SECONDS),
+                           "-i", str(file), "-ac", "1", "-ar", "16000", "-f", "s16le", "-"], capture_output=True).stdout
+
+
+# function to score how well a model understands a sample: mean confidence of the recognized words,
+# a model of the wrong language recognizes few words and is unsure about them
+def score(model, pcm):
+    rec = KaldiRecognizer(model, 16000)
+    rec.SetWords(True)
+    words = []
+    for i in range(0, len(pcm), 8000):
+        if rec.AcceptWaveform(pcm[i:i + 8000]):
+            words.extend(json.loads(rec.Result()).get("result", []))
+    words.extend(json.loads(rec.FinalResult()).get("result", []))
+    if len(words) < MIN_WORDS:
+        return 0.
+    return sum(w["conf"] for w in words) / len(words)
+
+
+# function to find the language of every file, models maps languages to vosk model directories
+# returns a dict of file to language, files without recognizable speech get the first language
+def identify_languages(files, models, cache, load, duration=lambda file: 0.):
+    languages = {}
+    files = list(files)
+    for c in range(0, len(files), CHUNK):
+        samples = {file: sample(file, duration(file)) for file in files[c:c + CHUNK]}
+        best = {file: (0., next(iter(models))) for file in samples}
+        #models that are already loaded go first, before loading the others may push them out
+        for language in sorted(models, key=lambda l: not cache.cached(models[l])):
+            model = cache.get(models[language], load)
+            for file, pcm in samples.items():
+                s = score(model, pcm)
+                if s > best[file][0]:
+                    best[file] = (s, language)
+        for file, (s, language) in best.items():
+            print(f"{file}: {language} ({s:.2f})")
+            languages[file] = language
+    return languages
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import hashlib
+import threading
+import argparse
+import subprocess
+from pathlib import Path
+
+#where decoded audio is kept between runs, can be changed with the VOSKRIBE_PCM_CACHE environment variable
+#(an empty string turns the cache off, media is then converted to a WAV next to it as before)
+PCM_CACHE_DIR = os.environ.get("VOSKRIBE_PCM_CACHE", str(Path.cwd() / ".voskribe-pcm"))
+#how many bytes of decoded audio the cache may hold, the least recently used files go first
+PCM_CACHE_BYTES = int(float(os.environ.get("VOSKRIBE_PCM_CACHE_BYTES", 20e9)))
+#audio used this recently may still be waiting for recognition in another process and is not evicted
+PCM_CACHE_GRACE = float(os.environ.get("VOSKRIBE_PCM_CACHE_GRACE", 900))
+#16 kHz mono, which is what vosk models are trained on, a third of the 48 kHz WAVs we used to write
+SAMPLE_RATE = 16000
+
+
+#decoded files handed out by get() in this process and not released yet, e.g. converted ahead and waiting for recognition
+inuse = {}
+lock = threading.Lock()
+
+
+def cachedir(directory=None):
+    directory = Path(directory if directory is not None else PCM_CACHE_DIR)
+    (directory / "keys").mkdir(parents=True, exist_ok=True)
+    return directory
+
+
+# function to hash the content of a file, remembered by path, size and mtime so unchanged files are only read once
+def content_key(file, directory=None):
+    stat = Path(file).stat()
+    memo = cachedir(directory) / "keys" / hashlib.sha1(f"{Path(file).resolve()}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()
+    if memo.exists():
+        return memo.read_text()
+    key = hashlib.sha1()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            key.update(block)
+    memo.write_text(key.hexdigest())
+    return key.hexdigest()
+
+
+# function to get the decoded audio of a media file as a 16 kHz mono WAV, decoding it only if it is not cached yet
+def get(file, directory=None, budget=None):
+    directory = cachedir(directory)
+    wav = directory / f"{content_key(file, directory)}.wav"
+    #marked before it is looked at, so another thread cannot evict it in between; a failed decode takes the mark back
+    with lock:
+        inuse[wav] = inuse.get(wav, 0) + 1
+    partial = wav.with_suffix(f".{os.getpid()}.{threading.get_ident()}.part")
+    try:
+        if wav.exists():
+            #the mtime of a cached file is when it was last used, eviction goes by it
+            os.utime(wav)
+            print("Using decoded audio of", file, "from the cache")
+            return wav
+        print("Decoding audio from", Path(file).suffix.upper(), "file:", file)
+        #decode into a temporary name first, so a cut-off run never leaves half a file in the cache
+        subprocess.run(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y", "-i", str(file),
+                        "-ac", "1", "-ar", str(SAMPLE_RATE), "-c:a", "pcm_s16le", "-f", "wav", str(partial)], check=True)
+        os.replace(partial, wav)
+    except:
+        release(wav)
+        partial.unlink(missing_ok=True)
+        raise
+    evict(directory, budget, keep=wav)
+    return wav
+
+
+# function to tell the cache a decoded file handed out by get() is not needed any more
+def release(wav):
+    with lock:
+        if wav in inuse:
+            inuse[wav] -= 1
+            if inuse[wav] <= 0:
+                del inuse[wav]
+
+
+# function to delete the least recently used audio (and what other tools cached next to it) until the cache fits its budget,
+# audio used within the last grace seconds is kept
+def evict(directory=None, budget=None, keep=None, grace=None):
+    directory = cachedir(directory)
+    budget = budget if budget is not None else PCM_CACHE_BYTES
+    grace = grace if grace is not None else PCM_CACHE_GRACE
+    wavs = []
+    for wav in directory.glob("*.wav"):
+        try:
+            stat = wav.stat()
+        except FileNotFoundError:
+            continue
+        wavs.append((stat.st_mtime, stat.st_size, wav))
+    wavs.sort()
+    used = sum(size for mtime, size, wav in wavs)
+    for mtime, size, wav in wavs:
+        if used <= budget:
+            break
+        if wav == keep or wav in inuse or time.time() - mtime < grace:
+            continue
+        for f in directory.glob(wav.stem + ".*"):
+            f.unlink(missing_ok=True)
+        used -= size
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cache of decoded 16 kHz mono audio shared by voskribe runs")
+    parser.add_argument("--cache", help="cache directory", default=PCM_CACHE_DIR, type=Path)
+    parser.add_argument("action", help="stats|trim|clear", choices=["stats", "trim", "clear"])
+    parser.add_argument("--budget", help="bytes to trim to", default=PCM_CACHE_BYTES, type=float)
+    args = parser.parse_args()
+
+    directory = cachedir(args.cache)
+    if args.action == "trim":
+        evict(directory, args.budget)
+    elif args.action == "clear":
+        evict(directory, 0, grace=0)
+        for memo in (directory / "keys").iterdir():
+            memo.unlink()
+    wavs = list(directory.glob("*.wav"))
+    used = sum(wav.stat().st_size for wav in wavs)
+    print(f"{len(wavs)} decoded file(s), {used / 1e9:.2f} of {PCM_CACHE_BYTES / 1e9:.2f} GB")
+    if len(wavs) > 0:
+        oldest = min(wav.stat().st_mtime for wav in wavs)
+        print("least recently used", time.strftime("%Y-%m-%d %H:%M", time.localtime(oldest)))
+
+
+if __name__ == '__main__':
+    main()
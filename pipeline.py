@@ -0,0 +1,54 @@
+import queue
+import threading
+
+#put into a queue after its last item
+DONE = object()
+
+
+# function to pass items through stages that work at the same time, every stage is (function, threads, buffered):
+# function takes an item and returns it for the next stage (or None to drop it), threads of the stage take items in parallel
+# and at most buffered results wait for the next stage, so a fast stage cannot run away from a slow one
+#monitor, if given, is called every interval seconds with the number of items waiting in front of every stage,
+#name turns an item into what is printed when a stage fails on it
+def run(items, stages, monitor=None, interval=1., name=str):
+    queues = [queue.Queue(maxsize=1)] + [queue.Queue(maxsize=max(1, buffered)) for function, threads, buffered in stages[:-1]] + [None]
+    threadlists = []
+
+    def work(function, source, target, running):
+        while True:
+            item = source.get()
+            if item is DONE:
+                #let the other threads of this stage see the end as well
+                source.put(DONE)
+                break
+            try:
+                item = function(item)
+            except Exception as e:
+                print("Failed:", name(item), e)
+                item = None
+            if item is not None and target is not None:
+                target.put(item)
+        with running[0]:
+            running[1] -= 1
+            if running[1] == 0 and target is not None:
+                target.put(DONE)
+
+    for s, (function, threads, buffered) in enumerate(stages):
+        running = [threading.Lock(), max(1, threads)]
+        threadlists.append([threading.Thread(target=work, args=(function, queues[s], queues[s + 1], running), daemon=True)
+                            for i in range(max(1, threads))])
+        for t in threadlists[-1]: t.start()
+
+    def feed():
+        for item in items:
+            queues[0].put(item)
+        queues[0].put(DONE)
+
+    threadlists.insert(0, [threading.Thread(target=feed, daemon=True)])
+    threadlists[0][0].start()
+    for threadlist in threadlists:
+        for t in threadlist:
+            while t.is_alive():
+                t.join(interval)
+                if monitor is not None:
+                    monitor([q.qsize() for q in queues[:-1]])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sqlite3
+import argparse
+import srt
+from pathlib import Path
+
+#where the full-text index of all transcripts is kept, can be changed with the VOSKRIBE_INDEX environment variable
+INDEX_FILE = Path(os.environ.get("VOSKRIBE_INDEX", Path.cwd() / "voskribe.sqlite"))
+#media we look for next to a subtitle file, the WAV comes last as it is usually just a conversion
+MEDIA_FORMATS = ['.mkv', '.mp4', '.webm', '.m4a', '.mp3', '.ogg', '.opus', '.wav']
+
+
+# function to open the index, creating its tables on first use
+# cuemedia maps every media file to the rowids of its cues, the media column of the fts table cannot be searched without a full scan
+def connect(indexfile=None):
+    connection = sqlite3.connect(str(indexfile if indexfile is not None else INDEX_FILE))
+    mapped = connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'cuemedia'").fetchone() is not None
+    connection.executescript("""
+        CREATE TABLE IF NOT EXISTS media (id INTEGER PRIMARY KEY, path TEXT UNIQUE, srt TEXT, mtime REAL);
+        CREATE VIRTUAL TABLE IF NOT EXISTS cues USING fts5(text, media UNINDEXED, start UNINDEXED, end UNINDEXED, tokenize='unicode61 remove_diacritics 2');
+        CREATE TABLE IF NOT EXISTS cuemedia (cue INTEGER PRIMARY KEY, media INTEGER);
+        CREATE INDEX IF NOT EXISTS cuemedia_media ON cuemedia (media);
+    """)
+    #indexes from before the mapping get it once
+    if not mapped:
+        with connection:
+            connection.execute("INSERT INTO cuemedia (cue, media) SELECT rowid, media FROM cues")
+    return connection
+
+
+# function to find the media file a subtitle file belongs to
+def find_media(srtfile):
+    for suffix in MEDIA_FORMATS:
+        if Path(srtfile).with_suffix(suffix).exists():
+            return Path(srtfile).with_suffix(suffix)
+    return Path(srtfile).with_suffix("")
+
+
+# function to (re)place all cues of one media file in the index, one row per subtitle cue with times in milliseconds
+def add_subtitles(connection, media, srtfile, subs):
+    mtime = Path(srtfile).stat().st_mtime if Path(srtfile).exists() else 0
+    with connection:
+        row = connection.execute("SELECT id FROM media WHERE path = ?", (str(media),)).fetchone()
+        if row is not None:
+            cues = connection.execute("SELECT cue FROM cuemedia WHERE media = ?", (row[0],)).fetchall()
+            connection.executemany("DELETE FROM cues WHERE rowid = ?", cues)
+            connection.execute("DELETE FROM cuemedia WHERE media = ?", (row[0],))
+            connection.execute("UPDATE media SET srt = ?, mtime = ? WHERE id = ?", (str(srtfile), mtime, row[0]))
+            mediaid = row[0]
+        else:
+            mediaid = connection.execute("INSERT INTO media (path, srt, mtime) VALUES (?, ?, ?)", (str(media), str(srtfile), mtime)).lastrowid
+        cues = [(connection.execute("INSERT INTO cues (text, media, start, end) VALUES (?, ?, ?, ?)",
+                     (s.content, mediaid, int(s.start.total_seconds() * 1000), int(s.end.total_seconds() * 1000))).lastrowid, mediaid) for s in subs]
+        connection.executemany("INSERT INTO cuemedia (cue, media) VALUES (?, ?)", cues)
+
+
+# function to index a subtitle file, skipping it if it did not change since it was last indexed
+def index_srt(connection, srtfile):
+    row = connection.execute("SELECT mtime FROM media WHERE srt = ?", (str(srtfile),)).fetchone()
+    if row is not None and row[0] == Path(srtfile).stat().st_mtime:
+        return False
+    with open(srtfile, 'r') as f: subs = list(srt.parse(f.read()))
+    add_subtitles(connection, find_media(srtfile), srtfile, subs)
+    return True
+
+
+# function to index all subtitle files below the given directories
+def index_tree(connection, directories):
+    for directory in directories:
+        for srtfile in sorted(Path(directory).rglob('*.srt')):
+            if index_srt(connection, srtfile):
+                print("indexed", srtfile)
+
+
+# function to search the cues, every word of the query is matched as a word prefix
+# returns media file, start and end in milliseconds and the cue text with the matches in brackets, best matches first
+def search(connection, query, limit=100):
+    words = re.findall(r'\w+', query)
+    if len(words) < 1:
+        return []
+    match = " ".join('"' + w + '"*' for w in words)
+    return connection.execute("""
+        SELECT media.path, cues.start, cues.end, snippet(cues, 0, '[', ']', '…', 16)
+        FROM cues JOIN media ON media.id = cues.media
+        WHERE cues MATCH ? ORDER BY rank LIMIT ?""", (match, limit)).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="full-text index of voskribe transcripts")
+    parser.add_argument("--index", help="index file", default=INDEX_FILE, type=Path)
+    actions = parser.add_subparsers(dest="action", required=True)
+    index = actions.add_parser("index", help="index all .srt files below the given directories")
+    index.add_argument("directories", nargs='+', type=Path)
+    find = actions.add_parser("search", help="search the indexed transcripts")
+    find.add_argument("query")
+    find.add_argument("-n", help="maximum number of hits", default=100, type=int)
+    args = parser.parse_args()
+
+    connection = connect(args.index)
+    if args.action == "index":
+        index_tree(connection, args.directories)
+    elif args.action == "search":
+        for media, start, end, text in search(connection, args.query, args.n):
+            print(f"{media} {start // 60000:02d}:{start // 1000 % 60:02d} ({start} - {end} ms) {text}")
+    connection.close()
+
+
+if __name__ == '__main__':
+    main()
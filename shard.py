@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+import time
+import hashlib
+import argparse
+import multiprocessing
+import cpus
+from pathlib import Path
+from jobqueue import LeaseStore
+from watch import MEDIA_SUFFIXES, is_candidate, setup_worker, remove_converted
+
+
+# function to list the media files still to do, in an order of its own for every worker so they rarely compete for the same file
+def candidates(root, worker):
+    paths = [p for p in root.rglob('*') if p.suffix in MEDIA_SUFFIXES and is_candidate(p)]
+    return sorted(paths, key=lambda p: hashlib.sha1((worker + str(p)).encode()).digest())
+
+
+# function run by every worker process on every host: claim files through leases until all of them are done
+def work(root, leasedir, ttl, chosenmodels, punctmodels, diarize, channels, keepwav, cores):
+    voskribe = setup_worker(chosenmodels, punctmodels, diarize, channels, cores)
+    leases = LeaseStore(leasedir, ttl)
+    leases.start_heartbeat()
+    while True:
+        #files leased by someone else (or failed a moment ago) are retried later, their lease expires if that host crashed
+        leased = 0
+        for path in candidates(root, leases.owner):
+            if leases.is_done(path):
+                continue
+            if not leases.claim(path):
+                leased += 1
+                continue
+            try:
+                voskribe.process(path)
+                leases.release(path)
+            except Exception as e:
+                print("Failed to transcribe", path, e)
+                leases.release(path, error=e)
+            remove_converted(voskribe, keepwav)
+        if leased == 0:
+            return
+        print(leased, "file(s) leased by other workers, waiting for them")
+        time.sleep(min(60., ttl / 4))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="transcribe a shared media tree together with other hosts")
+    parser.add_argument("root", help="media tree shared by all hosts", type=Path)
+    parser.add_argument("--model", help="vosk model directory, several to pick one per file by language", nargs='+', required=True, type=Path)
+    parser.add_argument("--punctuation", help="recasepunc model directory, one per language", nargs='*', default=[], type=Path)
+    parser.add_argument("--workers", help="number of transcription processes on this host", default=1, type=int)
+    parser.add_argument("--leases", help="lease directory shared by all hosts (default: ROOT/.voskribe-leases)", default=None, type=Path)
+    parser.add_argument("--ttl", help="seconds after which the lease of a crashed host can be taken over", default=600., type=float)
+    parser.add_argument("--diarize", help="label speakers", action='store_true')
+    parser.add_argument("--channels", help="transcribe every channel/track on its own, labelled by channel", action='store_true')
+    parser.add_argument("--keep-wav", help="keep converted WAV files", action='store_true')
+    args = parser.parse_args()
+
+    leasedir = args.leases if args.leases is not None else args.root / ".voskribe-leases"
+    #every worker gets its own cores, so the recognizers and torch threads of different workers do not compete
+    coresets = cpus.split(cpus.available(), args.workers)
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=work, args=(args.root, leasedir, args.ttl, args.model, args.punctuation, args.diarize, args.channels, args.keep_wav, coresets[i]))
+               for i in range(args.workers)]
+    for w in workers: w.start()
+    for w in workers: w.join()
+    print("Done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import argparse
+import numpy
+from pathlib import Path
+
+#where enrolled speakers are stored, can be changed with the VOSKRIBE_SPEAKERS environment variable
+SPEAKERS_DIR = Path(os.environ.get("VOSKRIBE_SPEAKERS", Path.cwd() / "speakers"))
+#maximum cosine distance (between 0 and 1) to count as an identification
+MAX_DISTANCE = 0.25
+#number of closest reference embeddings that may vote for a segment
+TOP_K = 5
+
+
+# index of enrolled speakers: one normalized float32 matrix with one row per reference embedding
+# (speakers.npy, memory-mapped) and the speaker name of every row (speakers.json)
+class SpeakerIndex:
+
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory is not None else SPEAKERS_DIR
+        self.store = self.directory / "speakers.npy"
+        self.index = self.directory / "speakers.json"
+        if self.store.exists() and self.index.exists():
+            self.embeddings = numpy.load(self.store, mmap_mode='r')
+            with open(self.index, "r") as file: self.rownames = json.load(file)
+        else:
+            self.embeddings = numpy.zeros((0, 0), dtype=numpy.float32)
+            self.rownames = []
+        self.update_ids()
+
+    def update_ids(self):
+        self.names = list(dict.fromkeys(self.rownames))
+        lookup = {name: i for i, name in enumerate(self.names)}
+        self.ids = numpy.array([lookup[n] for n in self.rownames], dtype=numpy.int64)
+
+    def __len__(self):
+        return len(self.names)
+
+    @staticmethod
+    def normalize(embeddings):
+        embeddings = numpy.asarray(embeddings, dtype=numpy.float32)
+        return embeddings / numpy.maximum(numpy.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    #add one or more reference embeddings for a speaker, enrolling the speaker if they are new
+    def add(self, name, embeddings):
+        embeddings = self.normalize(numpy.atleast_2d(embeddings))
+        if len(self.rownames) > 0 and embeddings.shape[1] != self.embeddings.shape[1]:
+            raise ValueError(f"embedding size {embeddings.shape[1]} does not match index size {self.embeddings.shape[1]}")
+        known = numpy.asarray(self.embeddings) if len(self.rownames) > 0 else numpy.zeros((0, embeddings.shape[1]), dtype=numpy.float32)
+        self.embeddings = numpy.vstack([known, embeddings])
+        self.rownames = self.rownames + [name] * len(embeddings)
+        self.update_ids()
+
+    #remove a speaker and all of their reference embeddings
+    def remove(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        keep = numpy.array([n != name for n in self.rownames], dtype=bool)
+        self.embeddings = numpy.asarray(self.embeddings)[keep]
+        self.rownames = [n for n in self.rownames if n != name]
+        self.update_ids()
+
+    #write matrix and name index, replacing the old files only once the new ones are complete
+    def save(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        embeddings = numpy.asarray(self.embeddings, dtype=numpy.float32)
+        #speakers.npy.tmp and speakers.json.tmp, with_suffix would give both the same name
+        storetmp = self.store.with_name(self.store.name + ".tmp")
+        indextmp = self.index.with_name(self.index.name + ".tmp")
+        with open(storetmp, "wb") as file: numpy.save(file, embeddings)
+        with open(indextmp, "w") as file: json.dump(self.rownames, file)
+        os.replace(storetmp, self.store)
+        os.replace(indextmp, self.index)
+
+    #top-k cosine search of a batch of embeddings against all reference embeddings with a single matrix product
+    #returns row indices and similarities of shape (len(embeddings), k), best match first
+    def search(self, embeddings, k=TOP_K):
+        embeddings = self.normalize(numpy.atleast_2d(embeddings))
+        if len(self.rownames) == 0:
+            return numpy.zeros((len(embeddings), 0), dtype=numpy.int64), numpy.zeros((len(embeddings), 0), dtype=numpy.float32)
+        similarities = embeddings @ self.embeddings.T
+        k = min(k, similarities.shape[1])
+        rows = numpy.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        best = numpy.take_along_axis(similarities, rows, axis=1)
+        order = numpy.argsort(-best, axis=1)
+        return numpy.take_along_axis(rows, order, axis=1), numpy.take_along_axis(best, order, axis=1)
+
+    #count votes per enrolled speaker for each embedding, the last column counts unidentified embeddings
+    def votes(self, embeddings, k=TOP_K, max_distance=MAX_DISTANCE):
+        rows, similarities = self.search(embeddings, k)
+        counts = numpy.zeros((len(rows), len(self.names) + 1), dtype=numpy.int64)
+        for i in range(len(rows)):
+            hits = rows[i][similarities[i] >= 1. - max_distance]
+            if len(hits) > 0:
+                counts[i, :len(self.names)] = numpy.bincount(self.ids[hits], minlength=len(self.names))
+            else:
+                counts[i, len(self.names)] = 1
+        return counts
+
+
+#read reference embeddings from text (.emb), numpy (.npy) or any audio file
+def read_embeddings(file):
+    file = Path(file)
+    if file.suffix == ".emb":
+        with open(file, "r") as f: return numpy.loadtxt(f, ndmin=2)
+    if file.suffix == ".npy":
+        return numpy.atleast_2d(numpy.load(file))
+    #audio needs the pyannote stack, only import it when we really have to embed something
+    import diarize
+    return diarize.embed_file(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="enroll and manage speakers for diarization")
+    parser.add_argument("--dir", help="speaker index directory", default=SPEAKERS_DIR, type=Path)
+    actions = parser.add_subparsers(dest="action", required=True)
+    add = actions.add_parser("add", help="enroll a speaker or add reference embeddings to them")
+    add.add_argument("name")
+    add.add_argument("files", help="embedding (.emb, .npy) or audio files", nargs='+', type=Path)
+    remove = actions.add_parser("remove", help="remove a speaker with all their reference embeddings")
+    remove.add_argument("name")
+    actions.add_parser("list", help="list enrolled speakers")
+    search = actions.add_parser("search", help="find the closest enrolled speakers")
+    search.add_argument("files", help="embedding (.emb, .npy) or audio files", nargs='+', type=Path)
+    search.add_argument("-k", help="number of matches", default=TOP_K, type=int)
+    args = parser.parse_args()
+
+    index = SpeakerIndex(args.dir)
+    if args.action == "add":
+        for file in args.files:
+            index.add(args.name, read_embeddings(file))
+        index.save()
+        print(f"{args.name}: {index.rownames.count(args.name)} reference embeddings")
+    elif args.action == "remove":
+        try:
+            index.remove(args.name)
+        except KeyError:
+            print(f"{args.name} is not enrolled.")
+            sys.exit(1)
+        index.save()
+        print(f"removed {args.name}")
+    elif args.action == "list":
+        for name in index.names:
+            print(f"{name} ({index.rownames.count(name)})")
+        print(f"{len(index)} speakers, {len(index.rownames)} reference embeddings")
+    elif args.action == "search":
+        for file in args.files:
+            rows, similarities = index.search(read_embeddings(file), args.k)
+            for r, s in zip(rows, similarities):
+                print(file.name, ", ".join(f"{index.rownames[row]} ({1. - sim:.2f})" for row, sim in zip(r, s)))
+
+
+if __name__ == '__main__':
+    main()
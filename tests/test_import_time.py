@@ -0,0 +1,33 @@
+import os
+import sys
+import subprocess
+from pathlib import Path
+import pytest
+
+REPO = Path(__file__).resolve().parents[1]
+#importing voskribe (without vosk's own shared library) has to stay below this, torch and transformers alone take seconds
+IMPORT_BUDGET = 1.0
+
+pytest.importorskip("numpy")
+pytest.importorskip("srt")
+
+
+@pytest.fixture
+def env(tmp_path):
+    #stand-in for vosk, so we measure our imports and not loading libvosk
+    (tmp_path / "vosk.py").write_text("class Model: pass\nclass KaldiRecognizer: pass\ndef SetLogLevel(level): pass\n")
+    return dict(os.environ, PYTHONPATH=os.pathsep.join([str(tmp_path), str(REPO)]))
+
+
+def test_no_torch_on_import(env, tmp_path):
+    subprocess.run([sys.executable, "-c", "import voskribe, sys; assert 'torch' not in sys.modules and 'transformers' not in sys.modules"],
+                   env=env, cwd=tmp_path, check=True)
+
+
+def test_import_time_budget(env, tmp_path):
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import voskribe"], env=env, cwd=tmp_path,
+                         capture_output=True, text=True, check=True).stderr
+    #lines look like "import time:       123 |      4567 | voskribe", cumulative microseconds in the second column
+    cumulative = [int(line.split("|")[1]) for line in out.splitlines() if line.startswith("import time:") and line.split("|")[2].strip() == "voskribe"]
+    assert len(cumulative) == 1
+    assert cumulative[0] / 1e6 < IMPORT_BUDGET
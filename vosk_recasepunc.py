@@ -8,11 +8,18 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import random
+import time
+import socket
+import copy
 import unicodedata
 import numpy as np
 import argparse
 from torch.utils.data import TensorDataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 
 from transformers import AutoModel, AutoTokenizer, BertTokenizer
 
@@ -27,6 +34,11 @@ default_config = argparse.Namespace(
     period=1000,
     lr=1e-5,
     dab_rate=0.1,
+    student_layers=4,
+    student_hidden_size=384,
+    temperature=2.0,
+    alpha=0.5,
+    processes=1,
     device='cuda',
     debug=False
 )
@@ -170,15 +182,30 @@ def compute_performance(config, model, loader):
     return total_loss / num_loss, all_correct2.item() / num_perf, all_correct1.item() / num_perf, fscore
 
 
-def fit(config, model, checkpoint_path, train_loader, valid_loader, iterations, valid_period=200, lr=1e-5):
+# soft cross-entropy between temperature-scaled student and teacher distributions (Hinton et al. 2015)
+def distillation_loss(student_scores, teacher_scores, temperature):
+    num_labels = student_scores.size(-1)
+    student_log_probs = F.log_softmax(student_scores.view(-1, num_labels) / temperature, dim=-1)
+    teacher_probs = F.softmax(teacher_scores.view(-1, num_labels) / temperature, dim=-1)
+    return F.kl_div(student_log_probs, teacher_probs, reduction='batchmean') * temperature ** 2
+
+
+def fit(config, model, checkpoint_path, train_loader, valid_loader, iterations, valid_period=200, lr=1e-5, teacher=None, rank=0):
     device = config.device
+    # in data-parallel training only rank 0 validates and checkpoints the unwrapped model
+    module = model.module if isinstance(model, DistributedDataParallel) else model
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(filter(lambda param: param.requires_grad, model.parameters()), lr=lr)
-    iteration = 0
+    if teacher is not None:
+        teacher.eval()
+    iteration = epoch = 0
     while True:
         model.train()
+        if isinstance(train_loader.sampler, DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
+        epoch += 1
         total_loss = num = 0
-        for x, y in tqdm(train_loader):
+        for x, y in tqdm(train_loader, disable=rank != 0):
             x = x.long().to(device)
             y = y.long().to(device)
             drop_at_boundaries(config.dab_rate, x, y, config.cls_token_id, config.sep_token_id, config.pad_token_id)
@@ -189,23 +216,30 @@ def fit(config, model, checkpoint_path, train_loader, valid_loader, iterations,
             loss1 = criterion(y_scores1.view(y1.size(0) * y1.size(1), -1), y1.view(y1.size(0) * y1.size(1)))
             loss2 = criterion(y_scores2.view(y2.size(0) * y2.size(1), -1), y2.view(y2.size(0) * y2.size(1)))
             loss = loss1 + loss2
+            # when distilling, mix the gold label loss with the teacher's soft punc/case targets
+            if teacher is not None:
+                with torch.no_grad():
+                    t_scores1, t_scores2 = teacher(x)
+                soft_loss = distillation_loss(y_scores1, t_scores1, config.temperature) + distillation_loss(y_scores2, t_scores2, config.temperature)
+                loss = config.alpha * soft_loss + (1 - config.alpha) * loss
             loss.backward()
             optimizer.step()
             total_loss += loss.item()
             num += len(y)
-            if iteration % valid_period == valid_period - 1:
+            if iteration % valid_period == valid_period - 1 and rank == 0:
                 train_loss = total_loss / num
-                valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore = compute_performance(config, model, valid_loader)
+                valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore = compute_performance(config, module, valid_loader)
+                model.train()
                 torch.save({
                     'iteration': iteration + 1,
-                    'model_state_dict': model.state_dict(),
+                    'model_state_dict': module.state_dict(),
                     'optimizer_state_dict': optimizer.state_dict(),
                     'train_loss': train_loss,
                     'valid_loss': valid_loss,
                     'valid_accuracy_case': valid_accuracy_case,
                     'valid_accuracy_punc': valid_accuracy_punc,
                     'valid_fscore': valid_fscore,
-                    'config': config.__dict__,
+                    'config': portable_config(config, checkpoint_path),
                 }, '%s.%d' % (checkpoint_path, iteration + 1))
                 print(iteration + 1, train_loss, valid_loss, valid_accuracy_case, valid_accuracy_punc, valid_fscore)
                 total_loss = num = 0
@@ -227,6 +261,15 @@ def batchify(max_length, x, y):
 
 
 def train(config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_path):
+    if config.processes > 1:
+        # data-parallel training on the cpu, one process per shard of the training set
+        # on a free port, so several trainings can run on one host
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        mp.spawn(train_worker, args=(config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_path, port), nprocs=config.processes)
+        return
+
     X_train, Y_train = batchify(config.max_length, torch.load(train_x_fn), torch.load(train_y_fn))
     X_valid, Y_valid = batchify(config.max_length, torch.load(valid_x_fn), torch.load(valid_y_fn))
 
@@ -241,20 +284,143 @@ def train(config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_pat
     fit(config, model, checkpoint_path, train_loader, valid_loader, config.updates, config.period, config.lr)
 
 
-def run_eval(config, test_x_fn, test_y_fn, checkpoint_path):
-    X_test, Y_test = batchify(config.max_length, torch.load(test_x_fn), torch.load(test_y_fn))
-    test_set = TensorDataset(X_test, Y_test)
-    test_loader = DataLoader(test_set, batch_size=config.batch_size)
+def train_worker(rank, config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, checkpoint_path, port):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group('gloo', rank=rank, world_size=config.processes)
+    # split the cores between workers instead of letting every process grab all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // config.processes))
+    config.device = torch.device('cpu')
+
+    X_train, Y_train = batchify(config.max_length, torch.load(train_x_fn), torch.load(train_y_fn))
+    X_valid, Y_valid = batchify(config.max_length, torch.load(valid_x_fn), torch.load(valid_y_fn))
+
+    train_set = TensorDataset(X_train, Y_train)
+    valid_set = TensorDataset(X_valid, Y_valid)
+
+    train_sampler = DistributedSampler(train_set, num_replicas=config.processes, rank=rank, shuffle=True, seed=config.seed)
+    # every rank takes its share of the batch, so the averaged gradient is that of one batch_size batch
+    # and the same number of updates takes 1/processes of the work per process
+    train_loader = DataLoader(train_set, batch_size=max(1, config.batch_size // config.processes), sampler=train_sampler)
+    valid_loader = DataLoader(valid_set, batch_size=config.batch_size)
+
+    # DistributedDataParallel broadcasts rank 0's initial weights and averages gradients on backward()
+    model = DistributedDataParallel(Model(config.flavor, config.device))
+
+    fit(config, model, checkpoint_path, train_loader, valid_loader, config.updates, config.period, config.lr, rank=rank)
+    dist.destroy_process_group()
+
+
+# a flavor stored next to the checkpoint (a distilled student) is saved relative to it,
+# so the checkpoint can be moved, e.g. into recasepunc-xx/, together with that directory
+def portable_config(config, checkpoint_path):
+    saved = dict(config.__dict__)
+    directory = os.path.dirname(os.path.abspath(checkpoint_path))
+    if saved.get('flavor') and os.path.isabs(saved['flavor']) and os.path.dirname(saved['flavor']) == directory:
+        saved['flavor'] = './' + os.path.basename(saved['flavor'])
+    return saved
 
+
+def resolve_flavor(config, checkpoint_path):
+    if config.flavor is not None and config.flavor.startswith('./'):
+        config.flavor = os.path.join(os.path.dirname(os.path.abspath(checkpoint_path)), config.flavor[2:])
+    return config
+
+
+def load_checkpoint(config, checkpoint_path):
     loaded = torch.load(checkpoint_path, map_location=config.device)
     if 'config' in loaded:
-        config = Config(**loaded['config'])
+        config = resolve_flavor(Config(**loaded['config']), checkpoint_path)
         init(config)
 
     model = Model(config.flavor, config.device)
     model.load_state_dict(loaded['model_state_dict'])
+    return config, model
+
+
+# build a smaller encoder of the teacher's architecture and store it like a model zoo flavor,
+# so that Model() and CasePuncPredictor can load the student without knowing about distillation
+def make_student(config, teacher, student_dir):
+    teacher_config = teacher.bert.config
+    student_config = copy.deepcopy(teacher_config)
+    heads = max(1, config.student_hidden_size // 64)
+    if hasattr(student_config, 'n_layers'): # flaubert/xlm
+        student_config.n_layers = config.student_layers
+        student_config.emb_dim = config.student_hidden_size
+        student_config.n_heads = heads
+    else:
+        student_config.num_hidden_layers = config.student_layers
+        student_config.hidden_size = config.student_hidden_size
+        student_config.num_attention_heads = heads
+        student_config.intermediate_size = 4 * config.student_hidden_size
+        # Model() sizes its heads by pooler_fc_size before hidden_size
+        if hasattr(student_config, 'pooler_fc_size'):
+            student_config.pooler_fc_size = config.student_hidden_size
+    student = AutoModel.from_config(student_config)
+
+    # with an unchanged hidden size, start from evenly spaced teacher layers instead of random weights
+    if not hasattr(student_config, 'n_layers') and student_config.hidden_size == teacher_config.hidden_size:
+        step = max(1, teacher_config.num_hidden_layers // config.student_layers)
+        state = {}
+        for key, value in teacher.bert.state_dict().items():
+            found = re.match(r'encoder\.layer\.(\d+)\.(.*)', key)
+            if found is None:
+                state[key] = value
+            elif int(found.group(1)) % step == 0 and int(found.group(1)) // step < config.student_layers:
+                state['encoder.layer.%d.%s' % (int(found.group(1)) // step, found.group(2))] = value
+        student.load_state_dict(state, strict=False)
+
+    os.makedirs(student_dir, exist_ok=True)
+    student.save_pretrained(student_dir)
+    config.tokenizer.save_pretrained(student_dir)
+
+
+def distill(config, train_x_fn, train_y_fn, valid_x_fn, valid_y_fn, teacher_checkpoint, checkpoint_path):
+    teacher_config, teacher = load_checkpoint(config, teacher_checkpoint)
+    for param in teacher.parameters():
+        param.requires_grad = False
+
+    # the student shares the teacher's tokenizer, so the tensorized data is valid for both
+    student_dir = os.path.abspath(checkpoint_path + '.student')
+    config.lang = teacher_config.lang
+    config.tokenizer = teacher_config.tokenizer
+    make_student(config, teacher, student_dir)
+    config.flavor = student_dir
+    init(config)
+
+    X_train, Y_train = batchify(config.max_length, torch.load(train_x_fn), torch.load(train_y_fn))
+    X_valid, Y_valid = batchify(config.max_length, torch.load(valid_x_fn), torch.load(valid_y_fn))
+
+    train_loader = DataLoader(TensorDataset(X_train, Y_train), batch_size=config.batch_size, shuffle=True)
+    valid_loader = DataLoader(TensorDataset(X_valid, Y_valid), batch_size=config.batch_size)
+
+    model = Model(config.flavor, config.device)
+    teacher.to(config.device)
+
+    fit(config, model, checkpoint_path, train_loader, valid_loader, config.updates, config.period, config.lr, teacher=teacher)
+
+
+def run_eval(config, test_x_fn, test_y_fn, checkpoint_path, teacher_checkpoint=None):
+    X_test, Y_test = batchify(config.max_length, torch.load(test_x_fn), torch.load(test_y_fn))
+    test_set = TensorDataset(X_test, Y_test)
+    test_loader = DataLoader(test_set, batch_size=config.batch_size)
+
+    if teacher_checkpoint is None:
+        config, model = load_checkpoint(config, checkpoint_path)
+        print(*compute_performance(config, model, test_loader))
+        return
 
-    print(*compute_performance(config, model, test_loader))
+    # compare a distilled student against its teacher: model size, accuracy and throughput
+    timings = {}
+    for name, path in [('teacher', teacher_checkpoint), ('student', checkpoint_path)]:
+        model_config, model = load_checkpoint(config, path)
+        start = time.time()
+        loss, accuracy_case, accuracy_punc, fscore = compute_performance(model_config, model, test_loader)
+        timings[name] = time.time() - start
+        params = sum(param.numel() for param in model.parameters())
+        print(name, 'params:', params, 'loss:', loss, 'case:', accuracy_case, 'punc:', accuracy_punc, 'fscore:', fscore,
+              'seconds:', round(timings[name], 2), 'tokens/s:', int(len(X_test) * model_config.max_length / timings[name]))
+    print('speedup: %.2fx' % (timings['teacher'] / timings['student']))
 
 
 def recase(token, label):
@@ -272,7 +438,7 @@ class CasePuncPredictor:
     def __init__(self, checkpoint_path, lang=default_config.lang, flavor=default_config.flavor, device=default_config.device):
         loaded = torch.load(checkpoint_path, map_location=device if torch.cuda.is_available() else 'cpu')
         if 'config' in loaded:
-            self.config = Config(**loaded['config'])
+            self.config = resolve_flavor(Config(**loaded['config']), checkpoint_path)
         else:
             self.config = Config(lang=lang, flavor=flavor, device=device)
         init(self.config)
@@ -336,7 +502,7 @@ class CasePuncPredictor:
 def generate_predictions(config, checkpoint_path):
     loaded = torch.load(checkpoint_path, map_location=config.device if torch.cuda.is_available() else 'cpu')
     if 'config' in loaded:
-        config = Config(**loaded['config'])
+        config = resolve_flavor(Config(**loaded['config']), checkpoint_path)
         init(config)
 
     model = Model(config.flavor, config.device)
@@ -708,6 +874,8 @@ def main(config, action, args):
 
     if action == 'train':
         train(config, *args)
+    elif action == 'distill':
+        distill(config, *args)
     elif action == 'eval':
         run_eval(config, *args)
     elif action == 'predict':
@@ -722,7 +890,7 @@ def main(config, action, args):
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument("action", help="train|eval|predict|tensorize|preprocess", type=str)
+    parser.add_argument("action", help="train|distill|eval|predict|tensorize|preprocess", type=str)
     parser.add_argument("action_args", help="arguments for selected action", type=str, nargs='*')
     parser.add_argument("--seed", help="random seed", default=default_config.seed, type=int)
     parser.add_argument("--lang", help="language (fr, en, zh)", default=default_config.lang, type=str)
@@ -735,6 +903,11 @@ if __name__ == '__main__':
     parser.add_argument("--period", help="validation period in updates", default=default_config.period, type=bool)
     parser.add_argument("--lr", help="learning rate", default=default_config.lr, type=bool)
     parser.add_argument("--dab-rate", help="drop at boundaries rate", default=default_config.dab_rate, type=bool)
+    parser.add_argument("--processes", help="number of local cpu processes for data-parallel training", default=default_config.processes, type=int)
+    parser.add_argument("--student-layers", help="number of encoder layers of a distilled student", default=default_config.student_layers, type=int)
+    parser.add_argument("--student-hidden-size", help="hidden size of a distilled student", default=default_config.student_hidden_size, type=int)
+    parser.add_argument("--temperature", help="softmax temperature for distillation", default=default_config.temperature, type=float)
+    parser.add_argument("--alpha", help="weight of the teacher loss against the gold label loss", default=default_config.alpha, type=float)
     config = Config(**parser.parse_args().__dict__)
 
     main(config, config.action, config.action_args)
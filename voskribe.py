@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import os
 import sys
 import subprocess
 import shlex
@@ -8,9 +9,20 @@ import wave
 import json
 import srt
 import datetime
-from transformers import logging
+import importlib.util
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from vosk import Model, KaldiRecognizer, SetLogLevel
-from vosk_recasepunc import CasePuncPredictor, WordpieceTokenizer, Config
+import searchindex
+import wordstore
+import metrics
+import fingerprint
+import models
+import pipeline
+import pcmcache
+import cpus
 
 
 # function to initialize vosk with a user picked language model
@@ -28,19 +40,27 @@ def initvosk():
         print("\nWhich language model do you want to use?")
         print("[0] quit")
         print(*(('[{0}] {1}\n').format(i, m.name) for i, m in enumerate(likelymodels, 1)), sep='')
+        print("[a] all of them, picking one for each file by its language")
         numbers = [*range(1,len(likelymodels)+1)]
-        answer = input(f"Number {numbers}: ")
-        while (int(answer) not in numbers) and (answer != '0'):
+        answer = input(f"Number {numbers} or a: ")
+        while (answer not in ['a', 'A']) and (int(answer) not in numbers) and (answer != '0'):
             answer = str(input("Not a valid answer. Number (0 = quit): "))
         if answer == '0': exit(1)
+        if answer in ['a', 'A']:
+            voskmodels = likelymodels
+            punctmodels = [x for x in Path.cwd().iterdir() if str(x).find('recasepunc-') > -1]
+            if len(punctmodels) > 0:
+                answer = str(input("\nUse the punctuation models of the same languages (Y/n)? "))
+                if answer in ["n", "N"]: punctmodels = []
+            routemodels(voskmodels, punctmodels)
+            return
         chosenmodel = likelymodels[int(answer)-1].name
 
     #look for subfolders of current directory with the word "recasepunc" in them
-    global predictor
+    punctmodel = None
     likelymodels = [x for x in Path.cwd().iterdir() if str(x).find('recasepunc-') > -1]
     if len(likelymodels) < 1:
         print ("\nNo punctuation model found. Continuing without one.")
-        predictor = 0
     #let user pick punctuation model
     else:
         print("\nDo you want to use a punctuation model?")
@@ -50,28 +70,95 @@ def initvosk():
         answer = input(f"Number {numbers}: ")
         if (int(answer) not in numbers) or (answer == '0'):
             print("None chosen.")
-            predictor = 0
         else:
-            print("\nInitalizing punctuation model", str(likelymodels[int(answer)-1].name))
-            #infer language from directory name, assuming consistent naming convention by vosk (this is crappy but it works for now)
-            langindex = str(likelymodels[int(answer)-1].name).index('recasepunc-') + 11
-            langcode = str(likelymodels[int(answer)-1].name)[langindex] + str(likelymodels[int(answer)-1].name)[langindex+1]
-            print("language: ", langcode)
-            predictor = 1
-
+            punctmodel = likelymodels[int(answer)-1]
 
     #initialize vosk with selected models
-    #(as of now, we can only choose our language model at the beginning of batch processing, as selecting for each individual file would be very time consuming and unpractical for larger numbers)
-    print("\nInitalizing vosk model...")
+    #(to pick a model for each individual file instead, answer "a" above and the language of every file is identified from a short sample)
+    loadmodels(chosenmodel, punctmodel)
+
+
+# function to load a vosk model and optionally a recasepunc model, without asking anything
+def loadmodels(chosenmodel, punctmodel=None):
+    global model, predictor
+    model = load_vosk(chosenmodel)
+    predictor = load_predictor(punctmodel) if punctmodel is not None else 0
+    print('')
+
+
+def load_vosk(chosenmodel):
+    print("\nInitalizing vosk model", Path(chosenmodel).name)
     SetLogLevel(0)
-    global model
-    model = Model(chosenmodel)
+    loaded = Model(str(chosenmodel))
     SetLogLevel(-1)
-    if predictor != 0:
-            #initialize casepunc model
-            logging.set_verbosity_error()
-            predictor = CasePuncPredictor(str(likelymodels[int(answer)-1].name)+'/checkpoint', lang=langcode)
-    print('')
+    return loaded
+
+
+def load_predictor(punctmodel):
+    print("\nInitalizing punctuation model", Path(punctmodel).name)
+    #infer language from directory name, assuming consistent naming convention by vosk (this is crappy but it works for now)
+    langindex = Path(punctmodel).name.index('recasepunc-') + 11
+    langcode = Path(punctmodel).name[langindex:langindex+2]
+    print("language: ", langcode)
+    #initialize casepunc model
+    #torch and transformers take seconds to import, so only do it when a punctuation model was chosen
+    from transformers import logging
+    import vosk_recasepunc
+    #checkpoints pickled by vosk_recasepunc.py refer to __main__.WordpieceTokenizer, whichever script we run as
+    sys.modules['__main__'].WordpieceTokenizer = vosk_recasepunc.WordpieceTokenizer
+    sys.modules['__main__'].Config = vosk_recasepunc.Config
+    logging.set_verbosity_error()
+    return vosk_recasepunc.CasePuncPredictor(str(Path(punctmodel) / 'checkpoint'), lang=langcode)
+
+
+# function to set up per-file language routing between several vosk models (and recasepunc models of the same languages)
+def routemodels(voskmodels, punctmodels=[]):
+    global modelcache, routes
+    modelcache = models.ModelCache()
+    routes = {}
+    for m in voskmodels:
+        routes.setdefault(models.model_language(m), [Path(m), None])
+    for p in punctmodels:
+        if models.model_language(p) in routes:
+            routes[models.model_language(p)][1] = Path(p)
+    print("\nRouting files between languages:", ", ".join(routes))
+
+
+# function to load one model pair, or to route between several models by language, e.g. for watch.py's workers
+def setupmodels(voskmodels, punctmodels=[]):
+    if len(voskmodels) == 1:
+        loadmodels(voskmodels[0], punctmodels[0] if len(punctmodels) > 0 else None)
+    else:
+        routemodels(voskmodels, punctmodels)
+
+
+# function to make the models of a language the current ones, loading them through the cache if needed
+def usemodels(language):
+    global model, predictor
+    voskmodel, punctmodel = routes[language]
+    model = modelcache.get(voskmodel, load_vosk)
+    predictor = modelcache.get(punctmodel, load_predictor) if punctmodel is not None else 0
+
+
+# function to find the language of media files with the routed models
+def identify(files):
+    print("\nIdentifying the language of", len(files), "file(s)...")
+    return models.identify_languages(files, {l: r[0] for l, r in routes.items()}, modelcache, load_vosk, fingerprint.duration)
+
+
+# function to get mono 16-bit audio of a media file, from the decoded-PCM cache or else converted to a WAV next to it
+def decode(file, convertwav=False):
+    #every channel is decoded on its own while recognizing
+    if channels:
+        return file
+    if not pcmcache.PCM_CACHE_DIR:
+        return convert2audio(file, convertwav)
+    #a WAV next to the media is our conversion of it from an earlier run, assume it has already been transcribed
+    if not convertwav and file.with_suffix(".wav").exists():
+        print(file.with_suffix(".wav"), "already exists. Skipping.")
+        return str("SkIpPeDeeDyP")
+    with metrics.stage("convert"):
+        return pcmcache.get(file)
 
 
 # function to extract audio from video files or convert other audio formats to WAV
@@ -95,7 +182,8 @@ def convert2audio(file, convertwav=False):
             file.replace(cleanfilename)
         #now let's call ffmpeg
         callffmpeg = u"ffmpeg -i \'" + cleanfilename + "\' -nostdin -hide_banner -loglevel error -ac 1 -ar 48000 \'" + cleanwav + "\'"
-        subprocess.call(shlex.split(callffmpeg))
+        with metrics.stage("convert"):
+            subprocess.call(shlex.split(callffmpeg))
         if cleanfilename != str(file):
             Path(cleanfilename).replace(file)
             Path(cleanwav).replace(newwav)
@@ -106,27 +194,89 @@ def convert2audio(file, convertwav=False):
         return str("SkIpPeDeeDyP")
 
 
-# function for vosk speech recognition
-def transcribe( file ):
+# function to diarize an audio file, runs in a separate worker process so pyannote is only ever imported there
+# its results are cached next to media, not next to the decoded audio, which may be evicted with the PCM cache
+def diarize_file(file, media=None):
+    from diarize import diarize
+    return diarize(file, cache_file=media).do_diarization()
+
+
+# function to assign a speaker to every word with one linear merge over words and speaker changes, both sorted by time
+def assign_speakers(words, speakerchanges):
+    turns = sorted(speakerchanges, key=lambda t: t["start"])
+    t = 0
+    for word in words:
+        middle = (word["start"] + word["end"]) / 2
+        while t < len(turns) - 1 and turns[t]["end"] <= middle:
+            t += 1
+        # words in gaps between turns go to the closer one of the neighbouring turns
+        if t > 0 and middle < turns[t]["start"] and middle - turns[t-1]["end"] < turns[t]["start"] - middle:
+            word["speaker"] = turns[t-1]["speaker"]
+        else:
+            word["speaker"] = turns[t]["speaker"] if turns else "???"
+    return words
+
+
+# function to feed a text through recasepunc, if we can
+def punctuate(text):
+    if predictor == 0:
+        return text
+    #take the cores the scheduler gives punctuation right now, set here as the count is kept per thread
+    if scheduler is not None:
+        scheduler.apply()
+    with metrics.stage("punctuate"):
+        tokens = list(enumerate(predictor.tokenize(text)))
+        results = ""
+        for token, case_label, punc_label in predictor.predict(tokens, lambda x: x[1]):
+            prediction = predictor.map_punc_label(predictor.map_case_label(token[1], case_label), punc_label)
+            if token[1][0] != '#':
+               results = results + ' ' + prediction
+            else:
+               results = results + prediction
+    return results.strip()
+
+
+# function for vosk speech recognition, punctuation and writing the outputs of one file
+def transcribe( file, audio=None ):
+    job = recognize(file, audio)
+    if job is not None:
+        write(arrange(job))
+
+
+# function to start the process diarizing files next to recognition, once
+def start_diarizer():
+    global diarizer
+    with diarizerlock:
+        if diarizer is None:
+            diarizer = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"))
+    return diarizer
+
+
+# function to recognize the speech in a file, audio is its decoded WAV if that is somewhere else (outputs are always named after file)
+# returns what arrange() and write() need or None if the file is skipped
+def recognize( file, audio=None ):
     #if a WAV to the requested media already exists, assume it has already been transcribed
-    if file == "SkIpPeDeeDyP":
-        return()
+    if file == "SkIpPeDeeDyP" or audio == "SkIpPeDeeDyP":
+        return None
     #open audio stream and check parameters, convert if necessary
-    wf = wave.open(str(file), "rb")
+    audiofile = audio if audio is not None else file
+    if channels:
+        return recognize_channels(file, audiofile)
+    wf = wave.open(str(audiofile), "rb")
     if wf.getnchannels() != 1 or wf.getsampwidth() != 2 or wf.getcomptype() != "NONE":
         print ("Audio file must be WAV mono PCM. Converting.")
-        convfile = convert2audio(file, True)
+        convfile = decode(file, True)
         if convfile == "SkIpPeDeeDyP":
-            return()
+            return None
+        audiofile = convfile
         wf = wave.open(str(convfile), "rb")
 
     #set up parameters
-    global diarization
     results = []
     subs = []
-    diary = []
-    WORDS_PER_LINE = 7
+    words = []
     duration = wf.getnframes() / wf.getframerate()
+    metrics.count("audio_duration", duration)
     durmin = int(duration // 60)
     dursek = int(duration % 60)
     rec = KaldiRecognizer(model, wf.getframerate())
@@ -134,76 +284,312 @@ def transcribe( file ):
 
     print('Transcribing audio file:', str(file))
 
+    #start diarization in its own process, so it runs while we decode
+    diarizing = None
     if diarization:
-        try:
-            import diarize
-            dia_obj = diarize(file)
-            diarization_dict = dia_obj.do_diarization()
-            dia_counter = 0
-        except:
-            print("Could not import diarize class.")
-            diarization = False
-            dia_counter = -1
+        diarizing = start_diarizer().submit(diarize_file, str(audiofile), str(file))
 
     #transcribe audio stream and print the progress
-    while True:
-        data = wf.readframes(4000)
-        if len(data) == 0:
-            break
-        if rec.AcceptWaveform(data):
-            # the results dict for a given frame range has the following structure:
-            # {'result': [{'conf': 1.0, 'end': 3.9, 'start': 3.6, 'word': 'XXX'}, {etc...etc], {'conf': 1.0, 'end': 4.08, 'start': 3.9, 'word': 'YYY'}], 'text': 'XXX...YYY'}
-            resultsjson = json.loads(rec.Result())
-            # sort words into our subtitle list
-            if "result" in resultsjson:
-                for j in range(0, len(resultsjson["result"]), WORDS_PER_LINE):
-                    line = resultsjson["result"][j : j + WORDS_PER_LINE]
-                    s = srt.Subtitle(index=len(subs),
-                        content=" ".join([l['word'] for l in line]),
-                        start=datetime.timedelta(seconds=line[0]['start']),
-                        end=datetime.timedelta(seconds=line[-1]['end']))
-                    subs.append(s)
-
-            # collect text lines into our fulltext list
-            if ("result" in resultsjson) and ("text" in resultsjson):
-                # we take the first start time, because this is where the whole text starts
-                # we could also calculate the duration here
-                starttime = resultsjson["result"][0]["start"]
-                timemin = int(starttime // 60)
-                timesek = int(starttime % 60)
-                res = str(resultsjson['text'])
-                results.append(res)
-                print(f"{res}                      ")
-                print(f"{timemin:02d}:{timesek:02d} of {durmin:02d}:{dursek:02d}", end='\r')
-
-            # collect diarized text, if chosen
-            #if "result" in resultsjson and diarization:
-            #    nextspeakerdict = diarization_dict[dia_counter]
-            #    nextspeakertime = nextspeakerdict['start']
-            #    while resultsjson["result"][word]["start"] < nextspeakertime:
-            #        diary.append(resultsjson["result"][word]["word"])
-
-
-    # feed the fulltext lines through recasepunc, if we can
-    if predictor != 0:
-        fulltext = " ".join(results)
-        tokens = list(enumerate(predictor.tokenize(fulltext)))
-        results = ""
-        for token, case_label, punc_label in predictor.predict(tokens, lambda x: x[1]):
-            prediction = predictor.map_punc_label(predictor.map_case_label(token[1], case_label), punc_label)
-            if token[1][0] != '#':
-               results = results + ' ' + prediction
+    with metrics.stage("decode"):
+        while True:
+            data = wf.readframes(4000)
+            metrics.count("bytes_read", len(data))
+            final = len(data) == 0
+            if final or rec.AcceptWaveform(data):
+                # the results dict for a given frame range has the following structure:
+                # {'result': [{'conf': 1.0, 'end': 3.9, 'start': 3.6, 'word': 'XXX'}, {etc...etc], {'conf': 1.0, 'end': 4.08, 'start': 3.9, 'word': 'YYY'}], 'text': 'XXX...YYY'}
+                # at the end of the file the words after the last pause are only given out by FinalResult
+                resultsjson = json.loads(rec.FinalResult() if final else rec.Result())
+                # sort words into our subtitle list
+                if "result" in resultsjson:
+                    words.extend(resultsjson["result"])
+                    for j in range(0, len(resultsjson["result"]), WORDS_PER_LINE):
+                        line = resultsjson["result"][j : j + WORDS_PER_LINE]
+                        s = srt.Subtitle(index=len(subs),
+                            content=" ".join([l['word'] for l in line]),
+                            start=datetime.timedelta(seconds=line[0]['start']),
+                            end=datetime.timedelta(seconds=line[-1]['end']))
+                        subs.append(s)
+
+                # collect text lines into our fulltext list
+                if len(resultsjson.get("result", [])) > 0 and ("text" in resultsjson):
+                    # we take the first start time, because this is where the whole text starts
+                    # we could also calculate the duration here
+                    starttime = resultsjson["result"][0]["start"]
+                    timemin = int(starttime // 60)
+                    timesek = int(starttime % 60)
+                    res = str(resultsjson['text'])
+                    results.append(res)
+                    print(f"{res}                      ")
+                    print(f"{timemin:02d}:{timesek:02d} of {durmin:02d}:{dursek:02d}", end='\r')
+            if final:
+                break
+
+    metrics.count("words", len(words))
+    return {"file": file, "audio": audiofile, "words": words, "subs": subs, "results": results, "diarizing": diarizing}
+
+
+# function to list the separately recorded voices of a file: its audio tracks if it has several, else the channels of its one track
+# returns a label and the ffmpeg arguments that pick out the voice for each of them
+def voices(file):
+    out = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "a", "-show_entries", "stream=channels", "-of", "csv=p=0", str(file)],
+                         capture_output=True, text=True).stdout.split()
+    streams = [int(c.strip(',')) for c in out if c.strip(',').isdigit()]
+    if len(streams) > 1:
+        return [(f"track {i+1}", ["-map", f"0:a:{i}", "-ac", "1"]) for i in range(len(streams))]
+    return [(f"channel {c+1}", ["-map", "0:a:0", "-af", f"pan=mono|c0=c{c}"]) for c in range(streams[0] if len(streams) > 0 else 1)]
+
+
+# function to recognize one voice of a file with its own recognizer, streaming its audio out of ffmpeg
+def recognize_voice(file, label, args):
+    ffmpeg = subprocess.Popen(["ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-i", str(file)] + args + ["-ar", "16000", "-f", "s16le", "-"],
+                              stdout=subprocess.PIPE)
+    rec = KaldiRecognizer(model, 16000)
+    rec.SetWords(True)
+    words = []
+    read = 0
+    #every voice is a recognizer of its own and takes one of the cores the batch gives to decoding
+    with scheduler.decoding() if scheduler is not None else contextlib.nullcontext():
+        while True:
+            data = ffmpeg.stdout.read(8000)
+            if len(data) == 0:
+                break
+            read += len(data)
+            if rec.AcceptWaveform(data):
+                words.extend(json.loads(rec.Result()).get("result", []))
+        words.extend(json.loads(rec.FinalResult()).get("result", []))
+    ffmpeg.wait()
+    for w in words:
+        w["speaker"] = label
+    print(f"{label}: {len(words)} words")
+    return words, read
+
+
+# function to recognize all channels (or tracks) of a file at the same time and merge their words in time order, labelled by channel
+def recognize_channels(file, audiofile):
+    voicelist = voices(audiofile)
+    print('Transcribing', len(voicelist), 'channels/tracks of audio file:', str(file))
+    with metrics.stage("decode"):
+        with ThreadPoolExecutor(max_workers=min(len(voicelist), len(CORES))) as pool:
+            recognized = list(pool.map(lambda voice: recognize_voice(audiofile, *voice), voicelist))
+    words = sorted((w for voicewords, read in recognized for w in voicewords), key=lambda w: w["start"])
+    read = sum(read for voicewords, read in recognized)
+    metrics.count("bytes_read", read)
+    metrics.count("audio_duration", read / 32000 / len(voicelist))
+    metrics.count("words", len(words))
+    return {"file": file, "audio": audiofile, "words": words, "subs": [], "results": [" ".join(w["word"] for w in words)], "diarizing": None}
+
+
+# function to label subtitles with speakers, if diarized, and to punctuate the fulltext
+def arrange(job):
+    words = job["words"]
+    subs = job["subs"]
+    results = job["results"]
+    diarizing = job["diarizing"]
+
+    # collect diarized text, if chosen: label subtitles with speakers and make one paragraph per speaker turn
+    speakerchanges = []
+    if diarizing is not None:
+        try:
+            with metrics.stage("diarize"):
+                speakerchanges = diarizing.result()
+        except Exception as e:
+            print("Diarization failed:", e)
+    if len(speakerchanges) > 0 and len(words) > 0:
+        assign_speakers(words, speakerchanges)
+    # words recognized per channel come with their speaker already
+    if len(words) > 0 and "speaker" in words[0]:
+        subs = []
+        paragraphs = []
+        j = 0
+        while j < len(words):
+            # one cue holds at most WORDS_PER_LINE words of the same speaker
+            line = [words[j]]
+            while len(line) < WORDS_PER_LINE and j + len(line) < len(words) and words[j + len(line)]["speaker"] == line[0]["speaker"]:
+                line.append(words[j + len(line)])
+            subs.append(srt.Subtitle(index=len(subs),
+                content=f"[{line[0]['speaker']}] " + " ".join([l['word'] for l in line]),
+                start=datetime.timedelta(seconds=line[0]['start']),
+                end=datetime.timedelta(seconds=line[-1]['end'])))
+            if len(paragraphs) > 0 and paragraphs[-1][0] == line[0]["speaker"]:
+                paragraphs[-1][1].extend(l['word'] for l in line)
             else:
-               results = results + prediction
+                paragraphs.append((line[0]["speaker"], [l['word'] for l in line]))
+            j += len(line)
+        results = "\n\n".join(f"{speaker}: {punctuate(' '.join(text))}" for speaker, text in paragraphs)
+    else:
+        # feed the fulltext lines through recasepunc, if we can
+        results = punctuate(" ".join(results))
+    job["subs"] = subs
+    job["results"] = results
+    return job
+
+
+# function to write the outputs of a recognized and arranged file
+def write(job):
+    file = job["file"]
+    subs = job["subs"]
+    results = job["results"]
+    with metrics.stage("write"):
+        # keep every recognized word with its times and confidence, so outputs can be regenerated without decoding again
+        newfile = file.with_suffix(".words.npy")
+        if (not nooverwrite) or (nooverwrite and not Path.exists(newfile)):
+            wordstore.save_words(file, job["words"])
+
+        # write subs to .srt and fulltext to .transcript file with the same name, if user didn't opt against it
+        newfile = file.with_suffix(".srt")
+        if (not nooverwrite) or (nooverwrite and not Path.exists(newfile)):
+            with open(newfile, 'w') as f: f.write(srt.compose(subs))
+        newfile = file.with_suffix(".transcript")
+        if (not nooverwrite) or (nooverwrite and not Path.exists(newfile)):
+            with open(newfile, 'w') as f: f.write(results)
+
+        # add the subtitle cues to the full-text index, so the transcript can be searched right away
+        try:
+            connection = searchindex.connect()
+            searchindex.add_subtitles(connection, searchindex.find_media(file.with_suffix(".srt")), file.with_suffix(".srt"), subs)
+            connection.close()
+        except searchindex.sqlite3.Error as e:
+            print("Could not index transcript:", e)
+    #diarization is done with the audio as well by now, the cache may evict it again
+    pcmcache.release(job["audio"])
+    print('Done:', str(file), '            ')
+
+
+# function to check whether the audio of a media file was transcribed before, e.g. as another container or bitrate of the same recording
+# if so, its outputs are linked (or copied) instead of decoding the file again; the fingerprint is kept for remember_fingerprint
+# a copy of a file still being transcribed in this batch waits for its outputs
+def reuse_duplicate(file):
+    remember_fingerprint(file)
+    with metrics.stage("fingerprint"):
+        seconds = fingerprint.duration(file)
+        bits = fingerprint.compute(file, seconds)
+    if len(bits) == 0:
+        return False
+    connection = fingerprint.connect()
+    original = fingerprint.find(connection, seconds, bits, exclude=file.with_suffix(''))
+    connection.close()
+    if original is None:
+        with fingerprintlock:
+            inflight = [other for other, (s, b) in fingerprints.items()
+                        if abs(s - seconds) <= fingerprint.MAX_DURATION_DIFFERENCE and fingerprint.same(b, bits)]
+            if len(inflight) == 0:
+                fingerprints[file] = (seconds, bits)
+                transcribed[file] = threading.Event()
+                return False
+            done = transcribed[inflight[0]]
+        print(file, "has the same audio as", inflight[0], "- waiting for its transcripts")
+        with metrics.stage("fingerprint"):
+            done.wait()
+        original = inflight[0].with_suffix('')
+        if not all(Path(str(original) + s).exists() for s in fingerprint.OUTPUT_SUFFIXES[:2]):
+            #the original failed, transcribe this copy after all
+            return reuse_duplicate(file)
+    print(file, "has the same audio as", original, "- linking its transcripts instead of transcribing again")
+    fingerprint.link_outputs(original, file.with_suffix(''))
+    metrics.count("audio_duration", seconds)
+    try:
+        connection = searchindex.connect()
+        searchindex.index_srt(connection, file.with_suffix(".srt"))
+        connection.close()
+    except searchindex.sqlite3.Error as e:
+        print("Could not index transcript:", e)
+    return True
+
+
+# function to remember the fingerprint of a file once it has its outputs, so later copies of its audio can reuse them,
+# also called when a file leaves the batch without outputs, so copies waiting for it go on
+def remember_fingerprint(file):
+    with fingerprintlock:
+        if file not in fingerprints:
+            return
+        seconds, bits = fingerprints[file]
+    if file.with_suffix(".srt").exists() and file.with_suffix(".transcript").exists():
+        connection = fingerprint.connect()
+        fingerprint.remember(connection, file.with_suffix(''), seconds, bits)
+        connection.close()
+    with fingerprintlock:
+        fingerprints.pop(file, None)
+        transcribed.pop(file).set()
+
+
+# function to convert and transcribe a single media file without asking anything, e.g. for watch.py's workers
+def process(file):
+    metrics.start(file)
+    if modelcache is not None:
+        usemodels(identify([file])[file])
+    try:
+        if not reuse_duplicate(file):
+            if file.suffix == '.wav':
+                transcribe(file)
+            elif file.with_suffix('.wav').exists():
+                #left over from an interrupted run, decode would skip the file
+                transcribe(file.with_suffix('.wav'))
+            else:
+                transcribe(file, decode(file))
+    finally:
+        remember_fingerprint(file)
+    metrics.finish()
+
 
-    # write subs to .srt and fulltext to .transcript file with the same name, if user didn't opt against it
-    newfile = file.with_suffix(".srt")
-    if (not nooverwrite) or (nooverwrite and not Path.exists(newfile)):
-        with open(newfile, 'w') as f: f.write(srt.compose(subs))
-    newfile = file.with_suffix(".transcript")
-    if (not nooverwrite) or (nooverwrite and not Path.exists(newfile)):
-        with open(newfile, 'w') as f: f.write(results)
-    print('Done.            ')
+# function to transcribe many files with conversion, recognition, punctuation and writing at work on different files at the same time
+def transcribe_batch(files):
+    #a file a stage fails on leaves the pipeline, close its record so it is not counted as in flight forever
+    def finishing(stage):
+        def run(item):
+            try:
+                return stage(item)
+            except:
+                remember_fingerprint(item[0] if isinstance(item, tuple) else item)
+                metrics.finish()
+                raise
+        return run
+
+    def converting(file):
+        record = metrics.start(file)
+        if reuse_duplicate(file):
+            remember_fingerprint(file)
+            metrics.finish()
+            return None
+        audio = file if file.suffix == '.wav' else decode(file)
+        if audio == "SkIpPeDeeDyP":
+            remember_fingerprint(file)
+            metrics.finish()
+            return None
+        return (file, record, audio)
+
+    #recognizers and punctuation share the cores, the scheduler moves them to whichever stage falls behind
+    global scheduler
+    scheduler = cpus.Scheduler(CORES, punctuation=predictor != 0)
+
+    def recognizing(item):
+        file, record, audio = item
+        metrics.use(record)
+        #a file recognized per channel takes a core for each of its voices in recognize_voice
+        with scheduler.decoding() if not channels else contextlib.nullcontext():
+            job = recognize(file, audio)
+        if job is None:
+            remember_fingerprint(file)
+            metrics.finish()
+            return None
+        return (file, record, job)
+
+    def punctuating(item):
+        metrics.use(item[1])
+        arrange(item[2])
+        return item
+
+    def writing(item):
+        file, record, job = item
+        metrics.use(record)
+        write(job)
+        remember_fingerprint(file)
+        metrics.finish()
+
+    pipeline.run(files, [(finishing(converting), CONVERTERS, DECODE_AHEAD), (finishing(recognizing), RECOGNIZERS or scheduler.cores, 1),
+                         (finishing(punctuating), PUNCTUATORS, 1), (finishing(writing), 1, 1)],
+                 monitor=lambda waiting: scheduler.rebalance(waiting[1], waiting[2]),
+                 name=lambda item: str(item[0] if isinstance(item, tuple) else item))
 
 
 # function to get input location when no files in work dir
@@ -213,12 +599,20 @@ def checkpath(thispath, fileformats):
         if PurePath(thispath).suffix == '.wav':
             print("Going on with specified WAV file.")
             initvosk()
+            if modelcache is not None:
+                usemodels(identify([thispath])[thispath])
+            metrics.start(thispath)
             transcribe(thispath)
+            metrics.finish()
             exit(1)
         elif str("*"+PurePath(thispath).suffix) in fileformats:
             print("Going on with specified media file.")
             initvosk()
-            transcribe(convert2audio(thispath))
+            if modelcache is not None:
+                usemodels(identify([thispath])[thispath])
+            metrics.start(thispath)
+            transcribe(thispath, decode(thispath))
+            metrics.finish()
             exit(1)
         else:
             print("Sorry, can only transcribe media files.")
@@ -237,78 +631,112 @@ def checkpath(thispath, fileformats):
             return thispath
 
 
-#set up some lists we will use for batch processing
+#settings and state shared by all transcriptions, changed by the interactive batch mode below or by watch.py
 fileformats = ['*.wav', '*.mkv', '*.mp4', '*.webm', '*.m4a', '*.mp3', '*.ogg', '*.opus']
-workable = []
-wavs = []
-others = []
 converted = []
 nooverwrite = False
 diarization = False
+#recognize every channel (or audio track) of a file on its own instead of downmixing, e.g. for calls with one speaker per channel
+channels = False
+diarizer = None
+predictor = 0
+WORDS_PER_LINE = 7
+#cores this process may use, see cpus.available()
+CORES = cpus.available()
+#fingerprints of files in flight, kept until their outputs are written, and set when that happened for copies waiting for them
+fingerprints = {}
+transcribed = {}
+fingerprintlock = threading.Lock()
+diarizerlock = threading.Lock()
+#shares the cores between recognizers and punctuation while transcribe_batch runs
+scheduler = None
+#threads converting media ahead of recognition, converted files waiting for it, recognizing and punctuating threads
+#(0 recognizers means one per core, of which the scheduler lets as many run as it gives cores to decoding)
+CONVERTERS = int(os.environ.get("VOSKRIBE_CONVERTERS", 2))
+DECODE_AHEAD = int(os.environ.get("VOSKRIBE_DECODE_AHEAD", 2))
+RECOGNIZERS = int(os.environ.get("VOSKRIBE_RECOGNIZERS", 0))
+PUNCTUATORS = int(os.environ.get("VOSKRIBE_PUNCTUATORS", 1))
+modelcache = None
+routes = {}
 
-#getting input files if not provided as an argument, prompt if there are none in work dir
-if len(sys.argv) > 1:
-    currentpath = checkpath(Path(sys.argv[1]), fileformats)
-else:
-    currentpath = Path.cwd()
-    for x in fileformats:
-        checked = sorted(currentpath.glob(x))
-        if len(checked) > 0: workable.extend(checked)
-    if len(workable) > 1:
-        answer = str(input(f"Found {len(workable)} in current directory. Transcribe those (y/N)? "))
-        if answer not in ["y", "Y"]: workable = []
-    while len(workable) < 1:
-        print("\nNo usable media files found in directory. \nDo you want to transcribe from a file/directory elsewhere?")
-        currentpath = checkpath(Path(input("path: ")), fileformats)
-print(f"{len(workable)} suitable media files total")
-
-# check if overwriting existing transcription files is ok
-toremove1 = sorted(currentpath.glob('*.transcript'))
-toremove2 = sorted(currentpath.glob('*.srt'))
-for t in toremove1:
-    if t.with_suffix(".srt") not in toremove2:
-        toremove1.remove(t)
-
-if len(toremove1) > 0:
-    answer = str(input("\nOverwrite already existing transcripts/subtitles (Y/n)?"))
-    if answer in ["n", "N"]:
-        nooverwrite = True
-        #remove all files that already have a transcript AND a srt from our list
-        workable[:] = [singlefile for singlefile in workable if not singlefile.with_suffix(".transcript") in toremove1]
-
-#if there is no more file in our list, break
-if len(workable) < 1:
-    print("No new files to transcribe. Stopping.")
-    exit(1)
-print(f"Continuing with {len(workable)} audio/video file(s).")
-
-#answer = str(input("\nDiarize recognized speech (y/N)?"))
-#if answer in ["y", "Y"]:
-#    print("not yet implemented")
-#    diarization = False
-
-initvosk()
-
-#seperate WAV files from other media files
-for singlefile in workable:
-    if singlefile.suffix == '.wav': wavs.append(singlefile)
-    else: others.append(singlefile)
-#transcribe WAV files first, as they might be already existing conversions of other media files
-if (len(wavs) >= 1):
-    print("Processing", len(wavs), "WAV file(s)...")
-    for singlewav in wavs:
-        transcribe(singlewav)
-#then go on to convert and transcribe other media files
-if len(others) >= 1:
-    print("\nProcessing", len(others), "media file(s)...")
-    for singleother in others:
-        transcribe(convert2audio(singleother))
-#if we created new WAVs, ask user whether to delete or keep them
-if len(converted) >= 1:
-    print("\nCreated", len(converted), "WAV files")
-    answer = str(input("Keep them (y/N)? "))
-    if answer in ["y", "Y"]:
-        exit(1)
+
+if __name__ == '__main__':
+
+    #set up some lists we will use for batch processing
+    workable = []
+
+    #getting input files if not provided as an argument, prompt if there are none in work dir
+    if len(sys.argv) > 1:
+        currentpath = checkpath(Path(sys.argv[1]), fileformats)
     else:
-        for todelete in converted: todelete.unlink()
+        currentpath = Path.cwd()
+        for x in fileformats:
+            checked = sorted(currentpath.glob(x))
+            if len(checked) > 0: workable.extend(checked)
+        if len(workable) > 1:
+            answer = str(input(f"Found {len(workable)} in current directory. Transcribe those (y/N)? "))
+            if answer not in ["y", "Y"]: workable = []
+        while len(workable) < 1:
+            print("\nNo usable media files found in directory. \nDo you want to transcribe from a file/directory elsewhere?")
+            currentpath = checkpath(Path(input("path: ")), fileformats)
+    print(f"{len(workable)} suitable media files total")
+
+    # check if overwriting existing transcription files is ok
+    toremove1 = sorted(currentpath.glob('*.transcript'))
+    toremove2 = sorted(currentpath.glob('*.srt'))
+    for t in toremove1:
+        if t.with_suffix(".srt") not in toremove2:
+            toremove1.remove(t)
+
+    if len(toremove1) > 0:
+        answer = str(input("\nOverwrite already existing transcripts/subtitles (Y/n)?"))
+        if answer in ["n", "N"]:
+            nooverwrite = True
+            #remove all files that already have a transcript AND a srt from our list
+            workable[:] = [singlefile for singlefile in workable if not singlefile.with_suffix(".transcript") in toremove1]
+
+    #if there is no more file in our list, break
+    if len(workable) < 1:
+        print("No new files to transcribe. Stopping.")
+        exit(1)
+    print(f"Continuing with {len(workable)} audio/video file(s).")
+
+    answer = str(input("\nTranscribe every channel/track on its own, e.g. one speaker per channel (y/N)?"))
+    if answer in ["y", "Y"]:
+        channels = True
+
+    #diarization needs pyannote, only offer it if it is installed, and is not needed with one speaker per channel
+    if not channels and importlib.util.find_spec("pyannote") is not None:
+        answer = str(input("\nDiarize recognized speech (y/N)?"))
+        if answer in ["y", "Y"]:
+            diarization = True
+
+    initvosk()
 
+    #with several models, group the files by language, so every model is loaded once
+    groups = {None: workable}
+    if modelcache is not None:
+        languages = identify(workable)
+        #languages whose models are still loaded from identifying go first
+        order = sorted(set(languages.values()), key=lambda l: not modelcache.cached(routes[l][0]))
+        groups = {l: [f for f in workable if languages[f] == l] for l in order}
+
+    for language, files in groups.items():
+        if language is not None:
+            print("\nTranscribing", len(files), "file(s) in", language)
+            usemodels(language)
+        #transcribe WAV files first, as they might be already existing conversions of other media files
+        wavs = [singlefile for singlefile in files if singlefile.suffix == '.wav']
+        others = [singlefile for singlefile in files if singlefile.suffix != '.wav']
+        print("Processing", len(wavs), "WAV file(s) and", len(others), "media file(s)...")
+        transcribe_batch(wavs + others)
+    if diarizer is not None:
+        diarizer.shutdown()
+    #if we created new WAVs, ask user whether to delete or keep them
+    if len(converted) >= 1:
+        print("\nCreated", len(converted), "WAV files")
+        answer = str(input("Keep them (y/N)? "))
+        if answer in ["y", "Y"]:
+            exit(1)
+        else:
+            for todelete in converted: todelete.unlink()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import signal
+import socket
+import argparse
+import multiprocessing
+import cpus
+from pathlib import Path
+from jobqueue import JobQueue, QUEUE_FILE
+import pcmcache
+try:
+    #watchdog uses inotify on linux, so new files are noticed right away
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    #without it we only notice new files by scanning the directories
+    Observer = None
+
+#media we pick up, same as the interactive batch mode
+MEDIA_SUFFIXES = ['.wav', '.mkv', '.mp4', '.webm', '.m4a', '.mp3', '.ogg', '.opus']
+
+
+# function to decide whether a file in a watched directory should be transcribed
+def is_candidate(path):
+    if path.suffix not in MEDIA_SUFFIXES or path.stem.endswith('_conv'):
+        return False
+    #decoded audio in the PCM cache is ours as well
+    if pcmcache.PCM_CACHE_DIR and Path(pcmcache.PCM_CACHE_DIR).resolve() in path.resolve().parents:
+        return False
+    #a WAV next to another media file with the same name is our own conversion of it
+    if path.suffix == '.wav' and any(path.with_suffix(s).exists() for s in MEDIA_SUFFIXES if s != '.wav'):
+        return False
+    return not (path.with_suffix('.srt').exists() and path.with_suffix('.transcript').exists())
+
+
+# watches directories and queues media files once they stopped growing for settle seconds
+class Watcher:
+
+    def __init__(self, directories, queue, settle=5., rescan=60.):
+        self.directories = directories
+        self.queue = queue
+        self.settle = settle
+        self.rescan = rescan
+        self.pending = {}
+        self.events = set()
+        self.lastscan = 0.
+
+    def check(self, path):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self.pending.pop(path, None)
+            return
+        if not is_candidate(path) or self.queue.known(path, stat.st_size, stat.st_mtime):
+            self.pending.pop(path, None)
+            return
+        size, mtime, since = self.pending.get(path, (None, None, time.time()))
+        if (size, mtime) != (stat.st_size, stat.st_mtime):
+            self.pending[path] = (stat.st_size, stat.st_mtime, time.time())
+        elif time.time() - since >= self.settle:
+            self.queue.add(path, stat.st_size, stat.st_mtime)
+            self.pending.pop(path)
+            print("queued", path)
+
+    def tick(self):
+        #a full scan catches files that arrived while we were down or that no event told us about
+        if time.time() - self.lastscan >= self.rescan:
+            self.lastscan = time.time()
+            for directory in self.directories:
+                for path in directory.rglob('*'):
+                    if path.suffix in MEDIA_SUFFIXES:
+                        self.check(path)
+        while self.events:
+            self.check(self.events.pop())
+        for path in list(self.pending):
+            self.check(path)
+
+
+if Observer is not None:
+    class EventHandler(FileSystemEventHandler):
+        def __init__(self, watcher):
+            self.watcher = watcher
+
+        def on_any_event(self, event):
+            if not event.is_directory:
+                self.watcher.events.add(Path(getattr(event, 'dest_path', None) or event.src_path))
+
+
+# function to set up a worker process of watch.py or shard.py: pin it to its cores, load the models once
+# and choose what voskribe does with every file, returns the voskribe module
+def setup_worker(chosenmodels, punctmodels, diarize, channels, cores):
+    #pin before vosk and torch are imported, so they size their thread pools to our share of the cores
+    cpus.pin(cores)
+    import voskribe
+    voskribe.setupmodels(chosenmodels, punctmodels)
+    voskribe.diarization = diarize
+    voskribe.channels = channels
+    return voskribe
+
+
+# function to delete the WAVs a worker converted for the files it transcribed, unless they are kept
+def remove_converted(voskribe, keepwav):
+    if not keepwav:
+        while voskribe.converted:
+            voskribe.converted.pop().unlink(missing_ok=True)
+
+
+# function run by every worker process: load the models once, then transcribe queued files until stopped
+def work(queuefile, chosenmodels, punctmodels, diarize, channels, keepwav, cores):
+    voskribe = setup_worker(chosenmodels, punctmodels, diarize, channels, cores)
+    queue = JobQueue(queuefile)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    #the daemon stops us with terminate(), exit through finally so the diarization process goes down with us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            path = queue.claim(worker)
+            if path is None:
+                time.sleep(1)
+                continue
+            try:
+                voskribe.process(path)
+                queue.done(path)
+            except Exception as e:
+                print("Failed to transcribe", path, e)
+                queue.fail(path, e)
+            remove_converted(voskribe, keepwav)
+    finally:
+        if voskribe.diarizer is not None:
+            voskribe.diarizer.shutdown(wait=False, cancel_futures=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="transcribe media files as soon as they land in the watched directories")
+    parser.add_argument("directories", nargs='+', type=Path)
+    parser.add_argument("--model", help="vosk model directory, several to pick one per file by language", nargs='+', required=True, type=Path)
+    parser.add_argument("--punctuation", help="recasepunc model directory, one per language", nargs='*', default=[], type=Path)
+    parser.add_argument("--workers", help="number of transcription processes", default=1, type=int)
+    parser.add_argument("--queue", help="queue file", default=QUEUE_FILE, type=Path)
+    parser.add_argument("--settle", help="seconds a file must stop growing before it is queued", default=5., type=float)
+    parser.add_argument("--rescan", help="seconds between full scans of the directories", default=60., type=float)
+    parser.add_argument("--diarize", help="label speakers", action='store_true')
+    parser.add_argument("--channels", help="transcribe every channel/track on its own, labelled by channel", action='store_true')
+    parser.add_argument("--keep-wav", help="keep converted WAV files", action='store_true')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+    recovered = queue.recover()
+    if recovered:
+        print("queued", recovered, "interrupted job(s) again")
+    watcher = Watcher(args.directories, queue, args.settle, args.rescan if Observer is not None else min(args.rescan, 2.))
+    if Observer is not None:
+        observer = Observer()
+        for directory in args.directories:
+            observer.schedule(EventHandler(watcher), str(directory), recursive=True)
+        observer.start()
+    else:
+        print("watchdog is not installed, falling back to scanning every", watcher.rescan, "seconds")
+
+    #every worker gets its own cores, so the recognizers and torch threads of different workers do not compete
+    coresets = cpus.split(cpus.available(), args.workers)
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=work, args=(args.queue, args.model, args.punctuation, args.diarize, args.channels, args.keep_wav, coresets[i]))
+               for i in range(args.workers)]
+    for w in workers: w.start()
+    print("watching", *args.directories)
+    try:
+        while True:
+            watcher.tick()
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        print("stopping, interrupted jobs will be picked up again on the next start")
+    finally:
+        if Observer is not None:
+            observer.stop()
+        #not daemonic, a worker starts its own process for diarization, which daemonic processes may not
+        for w in workers: w.terminate()
+        for w in workers: w.join()
+        queue.close()
+
+
+if __name__ == '__main__':
+    main()
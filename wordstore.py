@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import datetime
+import numpy
+import srt
+from pathlib import Path
+
+# one record per recognized word: id in the file's string table, start and end in seconds, confidence scaled to 0..255
+WORD_DTYPE = numpy.dtype([('word', '<u4'), ('start', '<f4'), ('end', '<f4'), ('conf', 'u1')])
+
+
+# function to store the words of a vosk result next to the media as <name>.words.npy and <name>.words.txt (string table)
+def save_words(file, words):
+    vocab = {}
+    records = numpy.zeros(len(words), dtype=WORD_DTYPE)
+    for i, w in enumerate(words):
+        records[i] = (vocab.setdefault(w['word'], len(vocab)), w['start'], w['end'], round(w.get('conf', 1.) * 255))
+    numpy.save(Path(file).with_suffix(".words.npy"), records)
+    with open(Path(file).with_suffix(".words.txt"), 'w', encoding='utf-8') as f:
+        f.write("\n".join(vocab))
+
+
+# function to load the stored words memory-mapped, returns string table and records
+def load_words(file):
+    with open(Path(file).with_suffix(".words.txt"), 'r', encoding='utf-8') as f:
+        vocab = f.read().split("\n")
+    return vocab, numpy.load(Path(file).with_suffix(".words.npy"), mmap_mode='r')
+
+
+# function to turn stored words back into dicts like those in vosk's results
+def iter_words(file):
+    vocab, records = load_words(file)
+    for r in records:
+        yield {'word': vocab[r['word']], 'start': float(r['start']), 'end': float(r['end']), 'conf': r['conf'] / 255}
+
+
+# function to group words into subtitles of at most words_per_line words, a pause longer than max_gap starts a new one
+def make_subtitles(words, words_per_line=7, max_gap=1.):
+    subs = []
+    line = []
+    for w in words:
+        if len(line) >= words_per_line or (len(line) > 0 and w['start'] - line[-1]['end'] > max_gap):
+            subs.append(srt.Subtitle(index=len(subs),
+                content=" ".join([l['word'] for l in line]),
+                start=datetime.timedelta(seconds=line[0]['start']),
+                end=datetime.timedelta(seconds=line[-1]['end'])))
+            line = []
+        line.append(w)
+    if len(line) > 0:
+        subs.append(srt.Subtitle(index=len(subs),
+            content=" ".join([l['word'] for l in line]),
+            start=datetime.timedelta(seconds=line[0]['start']),
+            end=datetime.timedelta(seconds=line[-1]['end'])))
+    return subs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="regenerate subtitles and transcripts from stored words, without the audio")
+    parser.add_argument("files", help="media files or their .words.npy", nargs='+', type=Path)
+    parser.add_argument("--words-per-line", help="maximum words per subtitle", default=7, type=int)
+    parser.add_argument("--max-gap", help="pause in seconds that starts a new subtitle", default=1., type=float)
+    parser.add_argument("--min-conf", help="drop words with a lower confidence (0..1)", default=0., type=float)
+    args = parser.parse_args()
+
+    for file in args.files:
+        file = Path(str(file).replace(".words.npy", ".wav"))
+        if not file.with_suffix(".words.npy").exists():
+            print("No stored words for", file)
+            continue
+        words = [w for w in iter_words(file) if w['conf'] >= args.min_conf]
+        with open(file.with_suffix(".srt"), 'w') as f: f.write(srt.compose(make_subtitles(words, args.words_per_line, args.max_gap)))
+        with open(file.with_suffix(".transcript"), 'w') as f: f.write(" ".join(w['word'] for w in words))
+        print("Regenerated", file.with_suffix(".srt"), "from", len(words), "words")
+
+
+if __name__ == '__main__':
+    main()